@@ -63,8 +63,11 @@ setup(
         # Specify the Python versions you support here.
         # In particular, ensure that you indicate whether you support
         # Python 2, Python 3 or both.
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
+    python_requires='>=3.8',
     cmdclass={'clean': MyClean}
 )
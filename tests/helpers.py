@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+
+class Clock(object):
+    '''A clock for timers and stores that only moves when told to.'''
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
@@ -0,0 +1,151 @@
+import asyncio
+from unittest import TestCase
+
+from yasm.core import Event, state_machine
+from yasm.nested import NestedMachine
+from yasm.aio import adispatch
+from yasm.stores import MemoryStore
+from yasm.utils import dispatch
+
+
+@state_machine('test')
+class Stuff(object):
+    pass
+
+
+@state_machine('test', machine_class=NestedMachine)
+class NestedStuff(object):
+    pass
+
+
+class TestAio(TestCase):
+
+    def setUp(self):
+        Stuff.machine._reset()
+        NestedStuff.machine._reset()
+
+    def test_async_callbacks(self):
+        calls = []
+
+        async def allowed(state, event, instance):
+            await asyncio.sleep(0)
+            return event.input == 'yes'
+
+        async def enter(state, event, instance, from_state):
+            await asyncio.sleep(0)
+            calls.append(('enter', state.name, from_state.name))
+
+        async def after(state, event, instance):
+            calls.append(('after', state.name))
+
+        m = Stuff.machine
+        m.add_states(['A', {'name': 'B', 'on_enter': enter}], initial='A')
+        m.add_transition('A', 'B', 'go', conditions=allowed, after=after)
+
+        async def run():
+            s = Stuff()
+            await adispatch(s, 'go', input='no')
+            self.assertEqual(s.state, 'A')
+            await adispatch(s, Event('go', input='yes'))
+            self.assertEqual(s.state, 'B')
+        asyncio.run(run())
+        self.assertEqual(calls, [('enter', 'B', 'A'), ('after', 'B')])
+
+    def test_sync_fast_path(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transition('A', 'B', 'go')
+        s = Stuff()
+        coro = adispatch(s, 'go')
+
+        async def run():
+            # completes on the first step, without suspending
+            with self.assertRaises(StopIteration):
+                coro.send(None)
+        asyncio.run(run())
+        self.assertEqual(s.state, 'B')
+        self.assertNotIn('_yasm_amailbox', s.__dict__)
+
+    def test_concurrent_machine(self):
+        async def after(state, event, instance):
+            dispatch(instance, 'back')
+
+        m = Stuff.machine
+        m.concurrent = True
+        self.addCleanup(setattr, m, 'concurrent', False)
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transition('A', 'B', 'go', after=after)
+        m.add_transition('B', 'A', 'back')
+
+        async def run():
+            s = Stuff()
+            await adispatch(s, 'go')
+            return s
+        s = asyncio.run(run())
+        self.assertEqual(s.state, 'A')
+        self.assertNotIn('_yasm_amailbox', s.__dict__)
+
+    def test_bookkeeping(self):
+        m = NestedStuff.machine
+        m.add_states(
+            [{'name': 'A', 'children': ['1', '2']}, 'B'], initial='A.1'
+        )
+        m.set_timeout('A.2', 5)
+        m.add_transition('A.1', 'A.2', 'go')
+        m.add_transition('A.2', 'B', 'go')
+        m.store = MemoryStore(key='key')
+        self.addCleanup(setattr, m, 'store', None)
+
+        async def run():
+            s = NestedStuff()
+            s.key = 'k'
+            await adispatch(s, 'go')
+            self.assertEqual(len(m.timers), 1)
+            self.assertEqual(m.store.load('k'), 'A.2')
+            await adispatch(s, 'go')
+            self.assertEqual(len(m.timers), 0)
+            self.assertEqual(m.store.load('k'), 'B')
+            return s
+        s = asyncio.run(run())
+        self.assertEqual(m.get_history(s), ('A.2', 'A.1'))
+
+    def test_run_to_completion(self):
+        log = []
+
+        async def before(state, event, instance):
+            log.append(('begin', event.input))
+            await asyncio.sleep(0.01 if event.input == 1 else 0)
+            log.append(('end', event.input))
+            if event.input == 1:
+                # re-entrant dispatch runs immediately
+                await adispatch(instance, 'noop', input=0)
+
+        async def noop(state, event, instance):
+            log.append(('noop', event.input))
+
+        m = NestedStuff.machine
+        m.add_states(
+            [{'name': 'A', 'children': ['1', '2']}], initial='A.1'
+        )
+        m.add_transitions([
+            {'from_state': 'A.1', 'to_state': 'A.2', 'event': 'step',
+             'before': before},
+            {'from_state': 'A.2', 'to_state': 'A.1', 'event': 'step',
+             'before': before},
+            {'from_state': 'A', 'to_state': 'A', 'event': 'noop',
+             'before': noop},
+        ])
+
+        async def run():
+            s = NestedStuff()
+            await asyncio.gather(*(adispatch(s, 'step', input=i)
+                                   for i in (1, 2, 3)))
+            return s
+        s = asyncio.run(run())
+        self.assertEqual(log, [
+            ('begin', 1), ('end', 1), ('noop', 0),
+            ('begin', 2), ('end', 2),
+            ('begin', 3), ('end', 3),
+        ])
+        self.assertEqual(s.state, 'A.2')
+        self.assertNotIn('_yasm_amailbox', s.__dict__)
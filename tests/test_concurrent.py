@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from threading import Barrier, Thread
+from unittest import TestCase
+
+from yasm.core import Machine, State, Event, state_machine
+from yasm.utils import dispatch, on_event
+
+
+class Counter(State):
+
+    @on_event('tick')
+    def tick(state, event, instance):
+        instance.count += 1
+
+
+@state_machine('concurrent')
+class Stuff(object):
+
+    def __init__(self):
+        self.count = 0
+        self.trace = []
+
+
+class TestConcurrent(TestCase):
+
+    def setUp(self):
+        m = Stuff.machine = Machine('concurrent', concurrent=True)
+        m.add_states([Counter('A'), Counter('B')], initial='A')
+        m.add_transition('A', 'B', 'flip')
+        m.add_transition('B', 'A', 'flip')
+
+    def test_clone(self):
+        self.assertTrue(Stuff.machine.clone().concurrent)
+
+    def test_threads(self):
+        stuffs = [Stuff() for _ in range(4)]
+        barrier = Barrier(8)
+
+        def work():
+            barrier.wait()
+            for _ in range(500):
+                for s in stuffs:
+                    dispatch(s, Event('tick'))
+                    dispatch(s, 'flip')
+
+        threads = [Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for s in stuffs:
+            self.assertEqual(s.count, 8 * 500)
+            # an even number of flips
+            self.assertEqual(s.state, 'A')
+            self.assertFalse(s._yasm_mailbox)
+
+    def test_run_to_completion(self):
+        m = Stuff.machine
+
+        def flipped(state, event, instance):
+            instance.trace.append(('enter', event.name))
+            if event.input == 'again':
+                dispatch(instance, Event('flip'))
+            instance.trace.append(('done', event.name))
+        m.add_transition('A', 'B', 'go', after=flipped)
+
+        s = Stuff()
+        dispatch(s, Event('go', input='again'))
+        # the nested dispatch ran once the outer one completed
+        self.assertEqual(s.trace, [('enter', 'go'), ('done', 'go')])
+        self.assertEqual(s.state, 'A')
@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
 try:
-    from unittest.mock import MagicMock
+    from unittest.mock import ANY, MagicMock
 except ImportError:
-    from mock import MagicMock
+    from mock import ANY, MagicMock
 
 from yasm.core import Machine, State, Event, state_machine
 from yasm import error
-from yasm.utils import dispatch
+from yasm.utils import dispatch, dispatch_many, feed, on_event, switch_to
 
 
 @state_machine('test', machine_class=Machine)
@@ -72,7 +72,7 @@ class TestCore(TestCase):
         m = Stuff.machine
         m.add_states(states, initial='A', force=True)
         m.add_transitions(transitions)
-        self.assertEqual(len(m.transitions), 8)
+        self.assertEqual(sum(map(len, m.transitions.values())), 4)
 
         # Define with list of lists
         transitions = [
@@ -133,6 +133,44 @@ class TestCore(TestCase):
         mc.add_state('D')
         self.assertNotEquals(list(m.states.keys()), list(mc.states.keys()))
 
+        # structure is shared until either side changes it
+        self.assertIs(m.states['A'], mc.states['A'])
+        # states are copied once got from either machine
+        on_go = MagicMock()
+        mc.get_state('A').handlers['go'] = on_go
+        self.assertIsNot(m.get_state('A'), mc.get_state('A'))
+        self.assertNotIn('go', m.get_state('A').handlers)
+        s = Stuff()
+        dispatch(s, Event('go'))
+        on_go.assert_not_called()
+        s.machine = mc
+        switch_to(s, 'A')
+        dispatch(s, Event('go'))
+        on_go.assert_called_once_with(mc.get_state('A'), ANY, s)
+        self.assertEqual(s.state, 'C')
+        mc.add_transition('A', 'D', 'go')
+        m.add_transition('B', 'A', 'go')
+        m.add_transition('*', 'A', 'reset')
+        self.assertEqual(len(m.get_transitions('A', 'go')), 1)
+        self.assertEqual(len(mc.get_transitions('A', 'go')), 2)
+        self.assertEqual(len(m.get_transitions('B', 'go')), 2)
+        self.assertEqual(len(mc.get_transitions('B', 'go')), 1)
+        self.assertEqual(len(m.wildcard_transitions), 1)
+        self.assertEqual(len(mc.wildcard_transitions), 0)
+        self.assertFalse(m.has_state('D'))
+        self.assertEqual(mc.state_codes['D'], 3)
+        self.assertNotIn('D', m.state_codes)
+        # dispatch never reads through layered maps
+        self.assertIs(type(mc.state_codes), dict)
+        self.assertEqual(len(m.state_list), 3)
+
+        # repeated cloning keeps the layers shallow
+        for _ in range(20):
+            mc = mc.clone()
+            mc.add_state(f'E{_}')
+        self.assertLessEqual(len(mc.states.maps), 9)
+        self.assertEqual(len(mc.states), 24)
+
     def test_enter_exit_state(self):
         mock = MagicMock()
 
@@ -176,3 +214,391 @@ class TestCore(TestCase):
             dispatch(s, Event('stop', raise_invalid_transition=True))
         dispatch(s, Event('relax'))
         self.assertEqual(s.state, 'standing')
+
+    def test_compile(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B', 'C'], initial='A')
+        m.add_transitions([
+            {'event': 'go', 'from_state': 'A', 'to_state': 'B',
+             'conditions': ['!is_manager', True]},
+            {'event': 'go', 'from_state': 'A', 'to_state': 'C',
+             'conditions': [False]},
+        ])
+        m.compile()
+        self.assertEqual(len(m._compiled[m.state_codes['A']][1]['go']), 1)
+
+        s = Stuff()
+        s.is_manager = False
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'B')
+
+        # new transitions only recompile their source state
+        compiled = m._compiled
+        m.add_transition('B', 'C', 'go')
+        self.assertIs(m._compiled, compiled)
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'C')
+
+        # new states and wildcards drop the compiled table
+        m.add_transition('*', 'A', 'reset')
+        self.assertIsNone(m._compiled)
+        m.compile()
+        m.add_state('D')
+        self.assertIsNone(m._compiled)
+
+    def test_freeze(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transition('A', 'B', 'go')
+        m.freeze()
+        self.assertTrue(m.frozen)
+        with self.assertRaises(error.FrozenMachine):
+            m.add_state('C')
+        with self.assertRaises(error.FrozenMachine):
+            m.add_transition('B', 'A', 'go')
+
+        s = Stuff()
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'B')
+
+        mc = m.clone()
+        self.assertFalse(mc.frozen)
+        mc.add_state('C')
+
+    def test_build(self):
+        m = Stuff.machine
+        states = ['s%d' % i for i in range(100)]
+        transitions = [
+            [states[i], states[(i + 1) % 100], 'next'] for i in range(100)
+        ]
+        transitions.append(['*', 's0', 'reset'])
+        self.assertIs(m.build(states, transitions, initial='s0'), m)
+        self.assertIsNotNone(m._compiled)
+        self.assertEqual(len(m.transitions), 100)
+
+        s = Stuff()
+        for _ in range(42):
+            dispatch(s, Event('next'))
+        self.assertEqual(s.state, 's42')
+        dispatch(s, Event('reset'))
+        self.assertEqual(s.state, 's0')
+
+        # wildcard transitions cover states added later and come after the
+        # state's own transitions
+        m.add_state('late')
+        m.add_transition('s0', 'late', 'reset', conditions='go_late')
+        s.go_late = True
+        dispatch(s, Event('reset'))
+        self.assertEqual(s.state, 'late')
+        s.go_late = False
+        dispatch(s, Event('reset'))
+        self.assertEqual(s.state, 's0')
+        dispatch(s, Event('reset'))
+        self.assertEqual(s.state, 's0')
+
+    def test_lookup_does_not_grow_transitions(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transition('A', 'B', 'go')
+        self.assertEqual(len(m.get_transitions('A', 'go')), 1)
+        self.assertEqual(m.get_transitions('A', 'stop'), ())
+        self.assertEqual(m.get_transitions('X', 'go'), ())
+
+        s = Stuff()
+        for i in range(100):
+            dispatch(s, Event(f'unknown{i}'))
+        dispatch(s, Event('go'))
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'B')
+        self.assertEqual(list(m.transitions), ['A'])
+        self.assertEqual(list(m.transitions['A']), ['go'])
+        self.assertEqual(len(m._compiled[m.state_codes['B']][1]), 0)
+
+    def test_state_codes(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B', 'C'], initial='A')
+        m.add_transition('A', 'B', 'go')
+        self.assertEqual(m.state_codes, {'A': 0, 'B': 1, 'C': 2})
+        self.assertEqual([s.name for s in m.state_list], ['A', 'B', 'C'])
+
+        # replacing a state keeps its code
+        state = State('B')
+        m.add_state('B', state, force=True)
+        self.assertEqual(m.state_codes['B'], 1)
+        self.assertIs(m.state_list[1], state)
+
+        s = Stuff()
+        self.assertEqual(s._state_code, 0)
+        dispatch(s, Event('go'))
+        self.assertEqual(s._state_code, 1)
+        self.assertEqual(s.state, 'B')
+
+        s.state = 'C'
+        self.assertEqual(s._state_code, 2)
+        with self.assertRaises(error.NoState):
+            s.state = 'X'
+        s.state = None
+        with self.assertRaises(error.NoState):
+            dispatch(s, Event('go'))
+
+    def test_dispatch_many(self):
+        mock = MagicMock()
+
+        def callback(state, event, instance):
+            mock()
+
+        m = Stuff.machine
+        m.add_states(['A', 'B', 'C'], initial='A')
+        m.get_state('A').handlers['tick'] = callback
+        m.add_transitions([
+            {'event': 'tick', 'from_state': 'A', 'to_state': 'B',
+             'after': callback},
+            {'event': 'tick', 'from_state': 'B', 'to_state': 'C',
+             'conditions': 'is_manager'},
+        ])
+
+        stuffs = [Stuff() for _ in range(10)]
+        for i, s in enumerate(stuffs):
+            s.is_manager = i % 2 == 0
+        dispatch_many(stuffs, Event('tick'))
+        self.assertEqual({s.state for s in stuffs}, {'B'})
+        self.assertEqual(mock.call_count, 20)
+
+        dispatch_many(stuffs, Event('tick'))
+        self.assertEqual(
+            [s.state for s in stuffs], ['C', 'B'] * 5
+        )
+        dispatch_many(stuffs, Event('tick'))
+        self.assertEqual(
+            [s.state for s in stuffs], ['C', 'B'] * 5
+        )
+        dispatch_many([], Event('tick'))
+        self.assertEqual(mock.call_count, 20)
+
+    def test_dispatch_by_name(self):
+        events = []
+
+        def callback(state, event, instance):
+            events.append((event.name, event.input))
+
+        m = Stuff.machine
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transitions([
+            {'event': 'go', 'from_state': 'A', 'to_state': 'B',
+             'conditions': lambda state, event, instance: event.input == 1,
+             'after': callback},
+        ])
+        s = Stuff()
+        dispatch(s, 'go', input=0)
+        self.assertEqual(s.state, 'A')
+        dispatch(s, 'go', input=1)
+        self.assertEqual(s.state, 'B')
+        self.assertEqual(events, [('go', 1)])
+        # the event object is recycled
+        self.assertEqual(len(m._event_pool), 1)
+        self.assertIsNone(m._event_pool[0].input)
+
+    def test_event(self):
+        event = Event('go')
+        self.assertFalse(hasattr(event, '__dict__'))
+        self.assertIsNone(event._cargo)
+        event.cargo['key'] = 'value'
+        self.assertEqual(event.cargo, {'key': 'value'})
+        self.assertEqual(Event('go', key='value').cargo, {'key': 'value'})
+
+    def test_slots(self):
+        mock = MagicMock()
+
+        class Entered(State):
+
+            def on_enter(self, event, instance, from_state):
+                mock(self.name, from_state.name)
+
+        m = Stuff.machine
+        m.add_states(['A', Entered], initial='A')
+        m.add_transition('A', 'Entered', 'go', after='on_go')
+        self.assertFalse(hasattr(m.get_state('A'), '__dict__'))
+
+        transition = m.get_transitions('A', 'go')[0]
+        self.assertEqual(transition.to_state, 'Entered')
+        self.assertEqual(transition['after'], 'on_go')
+        with self.assertRaises(KeyError):
+            transition['unknown']
+
+        s = Stuff()
+        s.on_go = MagicMock()
+        dispatch(s, Event('go'))
+        mock.assert_called_once_with('Entered', 'A')
+        self.assertTrue(s.on_go.called)
+
+    def test_named_callbacks(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B'], initial='A')
+        m.add_transition('A', 'B', 'go', before='log.before', after='on_go')
+        m.add_transition('B', 'A', 'go', before='log.before', after='on_go')
+
+        s = Stuff()
+        s.log, s.on_go = MagicMock(), MagicMock()
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'B')
+        s.log.before.assert_called_once_with(m.get_state('A'), ANY, s)
+        s.on_go.assert_called_once_with(m.get_state('B'), ANY, s)
+        self.assertEqual(feed(s, [Event('go'), Event('go')]), 2)
+        self.assertEqual(s.on_go.call_count, 3)
+
+    def test_class_handlers(self):
+        mock = MagicMock()
+
+        class Handled(State):
+
+            @on_event('ping')
+            def ping(state, event, instance):
+                mock(state.name)
+
+        self.assertEqual(Handled.class_handlers, {'ping': Handled.ping})
+        self.assertEqual(State.class_handlers, {})
+
+        one, two = Handled('one'), Handled('two')
+        self.assertEqual(one.handlers, {'ping': Handled.ping})
+        two.handlers['ping'] = lambda state, event, instance: None
+        self.assertEqual(one.handlers, {'ping': Handled.ping})
+        self.assertEqual(Handled.class_handlers, {'ping': Handled.ping})
+
+        m = Stuff.machine
+        m.add_states([one, two], initial='one')
+        s = Stuff()
+        dispatch(s, Event('ping'))
+        mock.assert_called_once_with('one')
+        switch_to(s, 'two')
+        dispatch(s, Event('ping'))
+        mock.assert_called_once_with('one')
+
+    def test_run_to_completion(self):
+        m = Machine('rtc', run_to_completion=True)
+        m.add_states(['A', 'B'], initial='A')
+        trace = []
+
+        def bounce(state, event, instance):
+            trace.append(event.input)
+            if event.input:
+                dispatch(instance, 'bounce', event.input - 1)
+            trace.append(-event.input)
+        m.add_transition('A', 'B', 'bounce', after=bounce)
+        m.add_transition('B', 'A', 'bounce', after=bounce)
+
+        @state_machine('rtc')
+        class Bouncer(object):
+            pass
+        Bouncer.machine = m
+        self.assertTrue(m.clone().run_to_completion)
+
+        s = Bouncer()
+        # far deeper than the recursion limit would allow
+        dispatch(s, Event('bounce', input=5000))
+        self.assertEqual(s.state, 'B')
+        self.assertEqual(trace[:4], [5000, -5000, 4999, -4999])
+        self.assertEqual(len(trace), 2 * 5001)
+        self.assertNotIn('_yasm_queue', s.__dict__)
+
+        def fail(state, event, instance):
+            dispatch(instance, 'bounce', 0)
+            raise ValueError(event.name)
+        m.add_transition('B', 'A', 'fail', after=fail)
+        with self.assertRaises(ValueError):
+            dispatch(s, 'fail')
+        # the queued bounce was dropped
+        self.assertEqual(s.state, 'A')
+        self.assertNotIn('_yasm_queue', s.__dict__)
+
+        # the batch entry points queue cascades the same way
+        del trace[:]
+        dispatch_many([s], Event('bounce', input=1))
+        self.assertEqual(trace, [1, -1, 0, 0])
+        del trace[:]
+        self.assertEqual(feed(s, [Event('bounce', input=1)]), 1)
+        self.assertEqual(trace, [1, -1, 0, 0])
+        del trace[:]
+        self.assertEqual(m.scan(s, [1, 0], 'bounce', stop_states=['B']), 2)
+        self.assertEqual(trace, [1, -1, 0, 0, 0, 0])
+        self.assertEqual(s.state, 'B')
+        del trace[:]
+        self.assertEqual(m.scan(s, [1], 'bounce'), 1)
+        self.assertEqual(trace, [1, -1, 0, 0])
+        self.assertEqual(s.state, 'B')
+
+    def test_inputs(self):
+        m = Stuff.machine
+        m.add_states(['A', 'B', 'C', 'D'], initial='A')
+        guard = MagicMock(return_value=True)
+        m.add_transitions([
+            {'from_state': 'A', 'to_state': 'B', 'event': 'go',
+             'inputs': '0123456789'},
+            ['A', 'C', 'go', [guard]],
+            ['A', 'D', 'go', None, None, None, {'x', '5', 7}],
+        ])
+        s = Stuff()
+        dispatch(s, 'go', '5')
+        self.assertEqual(s.state, 'B')
+        guard.assert_not_called()
+
+        for input, state in (('x', 'C'), (7, 'C'), ('y', 'C'), ([], 'C')):
+            switch_to(s, 'A')
+            dispatch(s, 'go', input)
+            self.assertEqual(s.state, state)
+        self.assertEqual(guard.call_count, 4)
+
+        guard.return_value = False
+        for input, state in (('x', 'D'), (7, 'D'), ('y', 'A'), ('1', 'B')):
+            switch_to(s, 'A')
+            dispatch(s, 'go', input)
+            self.assertEqual(s.state, state)
+
+        # keyed wildcards keep their order after the state's own records
+        m.add_transition('*', 'C', 'jump', inputs=['c'])
+        m.add_transition('B', 'D', 'jump', inputs='cd')
+        m.add_transition('B', 'A', 'jump')
+        for input, state in (('c', 'D'), ('d', 'D'), ('e', 'A')):
+            switch_to(s, 'B')
+            dispatch(s, 'jump', input)
+            self.assertEqual(s.state, state)
+        dispatch(s, 'jump', 'c')
+        self.assertEqual(s.state, 'C')
+        self.assertEqual(m.get_transitions('B', 'jump')[0].inputs, {'c', 'd'})
+
+    def test_scan(self):
+        m = Stuff.machine
+        m.add_states(['space', 'word'], initial='space')
+        tokens = []
+
+        def start(state, event, instance):
+            instance.start = instance.index
+
+        def end(state, event, instance):
+            tokens.append((instance.start, instance.index))
+
+        def step(state, event, instance):
+            instance.index += 1
+
+        letters = b'abcdefghijklmnopqrstuvwxyz'
+        m.add_transition('space', 'word', 'lex', inputs=letters, before=start)
+        m.add_transition('word', 'space', 'lex', inputs=b' ', before=end)
+        m.add_transition('space', 'space', 'lex', inputs=b' ')
+        m.add_transition('word', 'word', 'lex')
+        m.get_state('word').on_enter = MagicMock()
+        m.get_state('word').handlers['lex'] = step
+        m.get_state('space').handlers['lex'] = step
+
+        s = Stuff()
+        s.index = -1
+        text = b'  ab cde   f  '
+        self.assertEqual(m.scan(s, memoryview(text), 'lex'), len(text))
+        self.assertEqual(tokens, [(2, 4), (5, 8), (11, 12)])
+        self.assertEqual(s.state, 'space')
+        # entering `word` from itself is not skipped
+        self.assertEqual(m.get_state('word').on_enter.call_count, 6)
+
+        # unknown inputs of a keyed state are ignored
+        self.assertEqual(m.scan(s, b'?!', 'lex'), 2)
+        self.assertEqual(s.state, 'space')
+        with self.assertRaises(error.NoState):
+            m.scan(s, b'a', 'lex', stop_states=['nowhere'])
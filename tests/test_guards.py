@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from unittest import TestCase
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+from yasm.core import Machine, Event, state_machine
+from yasm.error import InvalidCondition
+from yasm.guards import GuardCache, compile_guard, is_expression, pure
+from yasm.utils import dispatch, switch_to
+
+
+@state_machine('guards')
+class Account(object):
+
+    def __init__(self, balance):
+        self.balance = balance
+        self.open = True
+
+
+class TestGuards(TestCase):
+
+    def setUp(self):
+        Account.machine = Machine('guards')
+
+    def test_is_expression(self):
+        self.assertFalse(is_expression('is_manager'))
+        self.assertFalse(is_expression('!account.open'))
+        self.assertTrue(is_expression('instance.open'))
+        self.assertTrue(is_expression('not instance.open'))
+        self.assertTrue(is_expression('event.input == 1'))
+        self.assertTrue(is_expression('!event.input'))
+        self.assertTrue(is_expression('!instance.balance > 0'))
+
+    def test_compile(self):
+        guard = compile_guard(
+            "instance.balance > 0 and event.input in ('a', 'b')"
+        )
+        self.assertEqual(
+            guard.expression,
+            "instance.balance > 0 and event.input in ('a', 'b')",
+        )
+        account = Mock(balance=10)
+        self.assertTrue(guard(None, Event('go', input='a'), account))
+        self.assertFalse(guard(None, Event('go', input='c'), account))
+        account.balance = -1
+        self.assertFalse(guard(None, Event('go', input='a'), account))
+
+        self.assertFalse(guard.pure)
+        self.assertTrue(compile_guard("event.input in 'ab'").pure)
+        self.assertTrue(compile_guard("state.name != event.name").pure)
+        self.assertFalse(compile_guard("event.cargo['x']").pure)
+        self.assertFalse(compile_guard("event.input == instance").pure)
+
+        guard = compile_guard("-instance.balance * 2 >= event.cargo['min']")
+        self.assertTrue(guard(None, Event('go', min=2), account))
+
+        guard = compile_guard(
+            "event.input[0] == 'a' and event.input[1:] == 'b'"
+        )
+        self.assertTrue(guard.pure)
+        self.assertTrue(guard(None, Event('go', input='ab'), account))
+        self.assertFalse(guard(None, Event('go', input='a'), account))
+        guard = compile_guard("event.cargo['grid'][1:, 0] == 1")
+        self.assertFalse(guard.pure)
+
+        for expression in ('instance.balance >', 'len(event.input)',
+                           'instance.__class__', 'balance > 0',
+                           '__import__("os")', 'lambda: 1',
+                           '[x for x in event.input]'):
+            with self.assertRaises(InvalidCondition, msg=expression):
+                compile_guard(expression)
+
+    def test_transitions(self):
+        m = Account.machine
+        m.add_states(['A', 'B', 'C'], initial='A')
+        m.add_transitions([
+            {'from_state': 'A', 'to_state': 'B', 'event': 'pay',
+             'conditions': 'instance.balance >= event.input'},
+            {'from_state': 'A', 'to_state': 'C', 'event': 'pay',
+             'conditions': ['open', 'not state.name == "B"']},
+        ])
+        with self.assertRaises(InvalidCondition):
+            m.add_transition('A', 'B', 'pay', conditions='balance > 0')
+
+        account = Account(10)
+        dispatch(account, Event('pay', input=5))
+        self.assertEqual(account.state, 'B')
+        switch_to(account, 'A')
+        dispatch(account, Event('pay', input=50))
+        self.assertEqual(account.state, 'C')
+
+        # a negated expression, not an instance path
+        m.add_transition('C', 'A', 'back', conditions='!event.input')
+        m.add_transition('C', 'B', 'back', conditions='!instance.balance > 5')
+        dispatch(account, Event('back', input=1))
+        self.assertEqual(account.state, 'C')
+        dispatch(account, Event('back'))
+        self.assertEqual(account.state, 'A')
+        switch_to(account, 'C')
+        account.balance = 1
+        dispatch(account, Event('back', input=1))
+        self.assertEqual(account.state, 'B')
+
+    def test_pure(self):
+        m = Account.machine
+        m.add_states(['A', 'B', 'C'], initial='A')
+        calls = []
+
+        @pure
+        def is_digit(state, event, instance):
+            calls.append(event.input)
+            return event.input.isdigit()
+
+        m.add_transition('A', 'B', 'go', conditions=[is_digit])
+        m.add_transition('A', 'C', 'go', conditions='event.input == "c"')
+        account = Account(0)
+        cache = m.guard_cache
+        for input in '1c1cx1':
+            switch_to(account, 'A')
+            dispatch(account, Event('go', input=input))
+        self.assertEqual(account.state, 'B')
+        self.assertEqual(calls, ['1', 'c', 'x'])
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 3, 3))
+
+        # any change to the transitions invalidates the cache
+        m.add_transition('B', 'A', 'back', conditions='open')
+        self.assertEqual(len(cache), 0)
+        switch_to(account, 'A')
+        dispatch(account, Event('go', input='1'))
+        self.assertEqual(calls, ['1', 'c', 'x', '1'])
+
+        # an impure guard disables caching of the whole event
+        m.add_transition('A', 'A', 'go', conditions='instance.open')
+        switch_to(account, 'A')
+        dispatch(account, Event('go', input='x'))
+        dispatch(account, Event('go', input='x'))
+        self.assertEqual(calls[-2:], ['x', 'x'])
+        self.assertEqual(len(cache), 0)
+
+        # unless the transition itself is declared pure
+        m.add_transition('B', 'C', 'hop', conditions='open', pure=True)
+        for _ in range(3):
+            switch_to(account, 'B')
+            dispatch(account, Event('hop'))
+            self.assertEqual(account.state, 'C')
+        self.assertEqual(len(cache), 1)
+
+    def test_cache(self):
+        cache = GuardCache(2)
+        cache.put(1, 'one')
+        cache.put(2, None)
+        self.assertIsNone(cache.get(2, 'missing'))
+        self.assertEqual(cache.get(1), 'one')
+        cache.put(3, 'three')
+        self.assertEqual(cache.get(2, 'missing'), 'missing')
+        cache.put([], 'unhashable')
+        self.assertEqual(cache.get([], 'missing'), 'missing')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        cache.clear()
+        self.assertEqual(cache.get(1), None)
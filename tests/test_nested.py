@@ -8,7 +8,7 @@ except ImportError:
 from yasm.core import Event, state_machine
 from yasm.nested import NestedState, NestedMachine
 from yasm import error
-from yasm.utils import dispatch
+from yasm.utils import dispatch, switch_to
 
 state_separator = NestedState.separator
 
@@ -78,7 +78,7 @@ class TestNested(TestCase):
         m = Stuff.machine
         m.add_states(states, initial='A', force=True)
         m.add_transitions(transitions)
-        self.assertEqual(len(m.transitions), 11)
+        self.assertEqual(sum(map(len, m.transitions.values())), 4)
 
         # Define with list of lists
         transitions = [
@@ -171,6 +171,322 @@ class TestNested(TestCase):
         self.assertEqual(s.state, 'D')
         self.assertEqual(mock.call_count, 3)
 
+    def test_clone(self):
+        m = NestedMachine('clone', concurrent=True)
+        m.add_states([{'name': 'A', 'children': ['1']}], initial='A.1')
+        mc = m.clone()
+        self.assertIsInstance(mc, NestedMachine)
+        self.assertTrue(mc.concurrent)
+        self.assertIs(mc.states['A.1'], m.states['A.1'])
+
+        # the whole tree of a state is copied once got
+        on_enter = MagicMock()
+        leaf = mc.get_state('A.1')
+        mc.get_state('A').on_enter = on_enter
+        self.assertIsNot(leaf, m.get_state('A.1'))
+        self.assertIs(leaf.parent, mc.get_state('A'))
+        self.assertEqual(leaf.ancestors, (mc.get_state('A'),))
+        self.assertIs(mc.get_state('A').children['1'], leaf)
+        self.assertIs(mc.state_list[mc.state_codes['A.1']], leaf)
+        self.assertIsNot(m.get_state('A').on_enter, on_enter)
+
+    def test_history(self):
+        mock = MagicMock()
+
+        def callback(state, event, instance, other_state):
+            mock(state.name, event.name)
+        m = Stuff.machine
+        m.add_states([
+            {'name': 'A', 'children': ['1', '2']},
+            {'name': 'B', 'on_enter': callback, 'on_exit': callback,
+             'children': ['1']},
+        ], initial='A.1')
+        m.add_transition('A.1', 'A.2', 'next')
+        m.add_transition('A.2', 'B.1', 'next')
+        s = Stuff()
+        m.revert_to_previous_leaf_state(s)
+        self.assertEqual(s.state, 'A.1')
+
+        dispatch(s, Event('next'))
+        dispatch(s, Event('next'))
+        self.assertEqual(m.get_history(s), ('A.2', 'A.1'))
+        mock.reset_mock()
+        m.set_previous_leaf_state(s)
+        self.assertEqual(s.state, 'A.2')
+        mock.assert_called_once_with('B', '__history__')
+        self.assertEqual(m.get_history(s), ('B.1', 'A.2', 'A.1'))
+
+        m.revert_to_previous_leaf_state(s, Event('back'))
+        self.assertEqual(s.state, 'B.1')
+        mock.assert_called_with('B', 'back')
+        self.assertEqual(m.get_history(s), ('A.2', 'A.1'))
+        m.revert_to_previous_leaf_state(s)
+        m.revert_to_previous_leaf_state(s)
+        self.assertEqual(s.state, 'A.1')
+        self.assertEqual(m.get_history(s), ())
+
+        # the oldest states are dropped, memory stays the same
+        history = s._yasm_history
+        for _ in range(m.STACK_SIZE):
+            switch_to(s, 'A.2')
+            switch_to(s, 'B.1')
+        self.assertEqual(len(history), m.STACK_SIZE)
+        self.assertEqual(len(history.codes), m.STACK_SIZE)
+        self.assertEqual(m.get_history(s)[:3], ('A.2', 'B.1', 'A.2'))
+
+    def test_scan_history(self):
+        m = Stuff.machine
+        m.add_states([{'name': 'A', 'children': ['1']}, 'B'],
+                     initial='A.1')
+        m.add_transition('A.1', 'A.1', 'lex', inputs='a')
+        m.add_transition('A.1', 'B', 'lex', inputs='b')
+        s, t = Stuff(), Stuff()
+        # scanning keeps the same history as dispatching every item
+        self.assertEqual(m.scan(s, 'aab', 'lex'), 3)
+        for char in 'aab':
+            dispatch(t, Event('lex', input=char))
+        self.assertEqual(s.state, 'B')
+        self.assertEqual(m.get_history(s), ('A.1', 'A.1', 'A.1'))
+        self.assertEqual(m.get_history(s), m.get_history(t))
+
+    def test_regions(self):
+        mock = MagicMock()
+
+        def callback(state, event, instance, other_state):
+            mock(state.name, instance.state)
+        m = Stuff.machine
+        m.add_states(['off', 'on'], initial='off')
+        m.add_region('auth', [
+            {'name': 'anonymous', 'on_exit': callback}, 'user',
+        ], 'anonymous')
+        m.add_region('billing', ['free', 'paid'], 'free')
+        m.add_transitions([
+            ['off', 'on', 'connect'],
+            ['on', 'off', 'close'],
+            ['auth.anonymous', 'auth.user', 'login'],
+            ['auth', 'auth.anonymous', 'close'],
+            ['billing.free', 'billing.paid', 'pay'],
+        ])
+        with self.assertRaises(error.InvalidTransition):
+            m.add_transition('on', 'auth.user', 'login')
+        with self.assertRaises(error.InvalidTransition):
+            m.add_transition('auth.user', 'billing.paid', 'pay')
+
+        s = Stuff()
+        self.assertEqual(
+            m.active_states(s), ('off', 'auth.anonymous', 'billing.free')
+        )
+        for name in ('connect', 'login', 'pay'):
+            dispatch(s, Event(name))
+        self.assertEqual(s.state, 'on')
+        self.assertEqual(
+            m.active_states(s), ('on', 'auth.user', 'billing.paid')
+        )
+        mock.assert_called_once_with('auth.anonymous', 'auth.anonymous')
+        # regions keep no history
+        self.assertEqual(m.get_history(s), ('off',))
+
+        # one event, several regions
+        dispatch(s, Event('close'))
+        self.assertEqual(
+            m.active_states(s), ('off', 'auth.anonymous', 'billing.paid')
+        )
+        with self.assertRaises(error.InvalidTransition):
+            dispatch(s, Event('nothing', raise_invalid_transition=True))
+        # handled by a region only
+        dispatch(s, Event('login', raise_invalid_transition=True))
+        self.assertEqual(
+            m.active_states(s), ('off', 'auth.user', 'billing.paid')
+        )
+        dispatch(s, Event('close'))
+
+        switch_to(s, 'billing.free')
+        switch_to(s, 'on')
+        self.assertEqual(
+            m.active_states(s), ('on', 'auth.anonymous', 'billing.free')
+        )
+        self.assertEqual(m.clone().regions, m.regions)
+
+        # wildcards and legacy switches stay in their region
+        m.add_transition('*', 'auth.user', 'jump')
+        m.add_transition('*', 'off', 'jump')
+        dispatch(s, Event('jump'))
+        self.assertEqual(
+            m.active_states(s), ('off', 'auth.user', 'billing.free')
+        )
+        dispatch(s, Event('__switch__', input='billing.paid'))
+        self.assertEqual(
+            m.active_states(s), ('off', 'auth.user', 'billing.paid')
+        )
+
+    def test_switch_to(self):
+        mock = MagicMock()
+
+        def callback(state, event, instance, other_state):
+            mock(state.name)
+        states = [
+            {'name': 'A', 'on_exit': callback},
+            {'name': 'C', 'on_enter': callback,
+             'children': [{'name': '1', 'on_exit': callback},
+                          {'name': '2', 'on_enter': callback}]},
+        ]
+        m = Stuff.machine
+        m.add_states(states=states, initial='A')
+        s = Stuff()
+        switch_to(s, 'C.1')
+        self.assertEqual(s.state, 'C.1')
+        self.assertEqual(
+            [c[0][0] for c in mock.call_args_list], ['A', 'C']
+        )
+        mock.reset_mock()
+        switch_to(s, 'C.2')
+        self.assertEqual(s.state, 'C.2')
+        self.assertEqual(
+            [c[0][0] for c in mock.call_args_list], ['C.1', 'C.2']
+        )
+
+    def test_deep_paths(self):
+        calls = []
+
+        def enter(state, event, instance, other_state):
+            calls.append(('enter', state.name))
+
+        def exit(state, event, instance, other_state):
+            calls.append(('exit', state.name))
+
+        def tree(name, depth):
+            state = {'name': name, 'on_enter': enter, 'on_exit': exit}
+            if depth:
+                state['children'] = [
+                    tree('x', depth - 1), tree('y', depth - 1)
+                ]
+            return state
+
+        m = Stuff.machine
+        m.add_states([tree('A', 3)], initial='A.x.x.x')
+        m.add_transition('A.x.x.x', 'A.x.y.y', 'go')
+        leaf = m.get_state('A.x.x.x')
+        self.assertEqual(leaf.depth, 3)
+        self.assertEqual(
+            [s.name for s in leaf.ancestors], ['A', 'A.x', 'A.x.x']
+        )
+        self.assertIs(m._get_top_state(leaf, m.get_state('A.x.y.y')),
+                      m.get_state('A.x'))
+
+        s = Stuff()
+        del calls[:]
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'A.x.y.y')
+        self.assertEqual(calls, [
+            ('exit', 'A.x.x.x'), ('exit', 'A.x.x'),
+            ('enter', 'A.x.y'), ('enter', 'A.x.y.y'),
+        ])
+        self.assertEqual(len(m._paths), 1)
+
+        m.PATH_CACHE_SIZE = 2
+        switch_to(s, 'A.y.y.y')
+        switch_to(s, 'A.x.x.x')
+        self.assertEqual(len(m._paths), 2)
+        del m.PATH_CACHE_SIZE
+
+    def test_handler_chains(self):
+        calls = []
+
+        def handler(state, event, instance):
+            calls.append(state.name)
+
+        def stop(state, event, instance):
+            calls.append(state.name)
+            event.propagate = False
+
+        m = Stuff.machine
+        m.add_states(
+            [{'name': 'A', 'children': [{'name': 'B', 'children': ['C']}]}],
+            initial='A.B.C'
+        )
+        m.add_transitions([['A', 'A.B.C', 'ping'], ['A', 'A.B.C', 'stop']])
+        m.get_state('A').handlers['ping'] = handler
+        m.get_state('A.B.C').handlers['ping'] = handler
+        m.get_state('A.B').handlers['stop'] = stop
+        m.get_state('A').handlers['stop'] = handler
+        m.compile()
+        leaf = m.get_state('A.B.C')
+        self.assertEqual(
+            [state.name for state, _ in leaf.handler_chains['ping']],
+            ['A.B.C', 'A']
+        )
+
+        s = Stuff()
+        dispatch(s, Event('ping'))
+        self.assertEqual(calls, ['A.B.C', 'A'])
+        del calls[:]
+        dispatch(s, Event('ping', propagate=False))
+        self.assertEqual(calls, ['A.B.C'])
+        del calls[:]
+        dispatch(s, Event('stop'))
+        self.assertEqual(calls, ['A.B'])
+
+        # handlers changed after dispatching take effect at once
+        del calls[:]
+        del m.get_state('A.B').handlers['stop']
+        m.get_state('A.B.C').handlers['stop'] = handler
+        dispatch(s, Event('stop'))
+        self.assertEqual(calls, ['A.B.C', 'A'])
+        del calls[:]
+        m.get_state('A').handlers = {'ping': stop}
+        dispatch(s, Event('ping'))
+        self.assertEqual(calls, ['A.B.C', 'A'])
+        dispatch(s, Event('stop'))
+        self.assertEqual(calls, ['A.B.C', 'A', 'A.B.C'])
+
+    def test_inherited_transitions(self):
+        m = Stuff.machine
+        m.add_states(
+            [{'name': 'A', 'children': [{'name': 'B', 'children': ['C']}]},
+             'D', 'E'],
+            initial='A.B.C'
+        )
+        m.add_transition('A', 'D', 'go')
+        m.compile()
+        compiled = m._compiled
+        records = compiled[m.state_codes['A.B.C']][1]
+        # nothing of their own, the whole mapping is shared
+        self.assertIs(records, compiled[m.state_codes['A']][1])
+        self.assertEqual(records['go'][0][1].name, 'D')
+
+        # added later, only the subtree of A.B is recompiled
+        m.add_transition('A.B', 'E', 'go')
+        self.assertIs(m._compiled, compiled)
+        records = compiled[m.state_codes['A.B.C']][1]
+        self.assertEqual(records['go'][0][1].name, 'E')
+        self.assertEqual(
+            compiled[m.state_codes['A']][1]['go'][0][1].name, 'D'
+        )
+
+        s = Stuff()
+        dispatch(s, Event('go'))
+        self.assertEqual(s.state, 'E')
+
+    def test_wildcards_before_ancestors(self):
+        m = Stuff.machine
+        m.add_states(
+            [{'name': 'P', 'children': ['1', '2']}, 'X', 'Y'],
+            initial='P.1'
+        )
+        m.add_transition('P', 'Y', 'e')
+        m.add_transition('P.2', 'P.1', 'e')
+        m.add_transition('*', 'X', 'e')
+
+        s = Stuff()
+        dispatch(s, Event('e'))
+        self.assertEqual(s.state, 'X')
+        switch_to(s, 'P')
+        dispatch(s, Event('e'))
+        self.assertEqual(s.state, 'Y')
+        switch_to(s, 'P.2')
+        dispatch(s, Event('e'))
+        self.assertEqual(s.state, 'P.1')
+
     def test_example_one(self):
         states = [
             'standing', 'walking',
@@ -6,7 +6,7 @@ from string import whitespace, digits
 from unittest import TestCase
 
 from yasm import Event, state_machine
-from yasm.utils import dispatch
+from yasm.utils import dispatch, feed, feed_inputs
 
 
 @state_machine('calculator')
@@ -97,3 +97,35 @@ class CalculatorTest(TestCase):
 
     def test_rpn(self):
         test_calc_callbacks()
+
+    def test_feed(self):
+        calc = Calculator()
+        self.assertEqual(feed_inputs(calc, 'parse', '3 4 + ='), 7)
+        self.assertEqual(calc.result, 7)
+        self.assertEqual(calc.state, 'result')
+
+        calc.reset()
+        events = (Event('parse', input=char) for char in '2 4 / =')
+        self.assertEqual(feed(calc, events), 7)
+        self.assertEqual(calc.result, 0.5)
+
+        # stop as soon as the result is known, leave the rest unconsumed
+        calc.reset()
+        chars = iter('3 4 * =5 6')
+        consumed = feed_inputs(calc, 'parse', chars, stop_states=['result'])
+        self.assertEqual(consumed, 7)
+        self.assertEqual(calc.result, 12)
+        self.assertEqual(''.join(chars), '5 6')
+
+    def test_scan(self):
+        calc = Calculator()
+        m = Calculator.machine
+        self.assertEqual(m.scan(calc, ' 167 3 2 2 * * * 1 - ='), 22)
+        self.assertEqual(calc.result, 2003)
+
+        calc.reset()
+        text = '3 4 * =5 6'
+        offset = m.scan(calc, text, stop_states=['result'])
+        self.assertEqual(offset, 7)
+        self.assertEqual(calc.result, 12)
+        self.assertEqual(text[offset:], '5 6')
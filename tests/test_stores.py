@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import sqlite3
+from os import path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from yasm.aio import run_store
+from yasm.core import Machine, Event, state_machine
+from yasm.nested import NestedMachine
+from yasm.stores import MemoryStore, SQLiteStore, StateStore
+from yasm.utils import dispatch
+from yasm import error
+
+from .helpers import Clock
+
+
+@state_machine('orders')
+class Order(object):
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestStores(TestCase):
+
+    def setUp(self):
+        m = Order.machine = Machine('orders')
+        m.add_states(['new', 'paid', 'shipped'], initial='new')
+        m.add_transition('new', 'paid', 'pay')
+        m.add_transition('paid', 'shipped', 'ship')
+
+    def test_memory(self):
+        m = Order.machine
+        m.store = MemoryStore()
+        orders = [Order(i) for i in range(3)]
+        dispatch(orders[0], Event('pay'))
+        dispatch(orders[1], Event('pay'))
+        dispatch(orders[1], Event('ship'))
+        self.assertEqual(m.store.states, {0: 'paid', 1: 'shipped'})
+
+        loaded = [Order(i) for i in range(3)]
+        self.assertEqual(m.hydrate(loaded), 2)
+        self.assertEqual(
+            [order.state for order in loaded], ['paid', 'shipped', 'new']
+        )
+        self.assertEqual(m.store.load(1), 'shipped')
+        self.assertIsNone(m.store.load(2))
+
+        # new and reinitialised instances are in the initial state
+        m.reinit_instance(loaded[1])
+        self.assertEqual(m.store.states, {0: 'paid'})
+        Order(0)
+        self.assertEqual(m.store.states, {0: 'paid'})
+
+        # scanning saves like dispatching
+        m.add_transition('paid', 'paid', 'pay', inputs='w')
+        m.store.states.clear()
+        m.scan(loaded[0], 'ww', 'pay')
+        self.assertEqual(m.store.states, {0: 'paid'})
+
+    def test_sqlite(self):
+        clock = Clock()
+        connection = sqlite3.connect(':memory:')
+        store = SQLiteStore(
+            connection, batch_size=3, flush_interval=1, clock=clock
+        )
+        m = Order.machine
+        m.store = store
+        count = 'SELECT count(*) FROM yasm_states'
+        orders = [Order(i) for i in range(4)]
+        dispatch(orders[0], Event('pay'))
+        dispatch(orders[0], Event('ship'))
+        self.assertEqual(connection.execute(count).fetchone(), (0,))
+        # pending states are visible
+        self.assertEqual(store.load_many([0, 1]), {0: 'shipped'})
+
+        dispatch(orders[1], Event('pay'))
+        self.assertEqual(connection.execute(count).fetchone(), (2,))
+        self.assertEqual(store.pending, {})
+
+        dispatch(orders[2], Event('pay'))
+        clock.now += 1
+        dispatch(orders[3], Event('pay'))
+        self.assertEqual(connection.execute(count).fetchone(), (4,))
+
+        dispatch(orders[3], Event('ship'))
+        store.flush()
+        loaded = [Order(i) for i in range(5)]
+        self.assertEqual(m.hydrate(loaded), 4)
+        self.assertEqual(
+            [order.state for order in loaded],
+            ['shipped', 'paid', 'paid', 'shipped', 'new'],
+        )
+        m.reinit_instance(loaded[2])
+        self.assertEqual(len(store.load_many(range(5))), 3)
+        store.flush()
+        self.assertEqual(connection.execute(count).fetchone(), (3,))
+        with self.assertRaises(ValueError):
+            SQLiteStore(connection, table='states; DROP TABLE x')
+        store.close()
+
+    def test_sqlite_tick(self):
+        clock = Clock()
+        connection = sqlite3.connect(':memory:')
+        store = SQLiteStore(connection, flush_interval=1, clock=clock)
+        m = Order.machine
+        m.store = store
+        count = 'SELECT count(*) FROM yasm_states'
+        dispatch(Order(0), Event('pay'))
+        m.tick()
+        self.assertEqual(connection.execute(count).fetchone(), (0,))
+        # written once due even without further saves
+        clock.now += 1
+        m.tick()
+        self.assertEqual(connection.execute(count).fetchone(), (1,))
+        self.assertEqual(store.pending, {})
+        store.close()
+
+    def test_run_store(self):
+        connection = sqlite3.connect(':memory:')
+        store = SQLiteStore(connection, flush_interval=0.02)
+        Order.machine.store = store
+        count = 'SELECT count(*) FROM yasm_states'
+
+        async def main():
+            task = asyncio.ensure_future(run_store(store))
+            dispatch(Order(0), Event('pay'))
+            await asyncio.sleep(0.1)
+            self.assertEqual(connection.execute(count).fetchone(), (1,))
+            dispatch(Order(1), Event('pay'))
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(main())
+        # flushed when cancelled
+        self.assertEqual(connection.execute(count).fetchone(), (2,))
+        store.close()
+
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            StateStore()
+
+    def test_no_store(self):
+        with self.assertRaises(error.NoStore):
+            Order.machine.hydrate([Order(0)])
+
+    def test_sqlite_threads(self):
+        with TemporaryDirectory() as directory:
+            store = SQLiteStore(
+                path.join(directory, 'states.db'), batch_size=7
+            )
+            m = Order.machine
+            m.store = store
+
+            def work(start):
+                for order in [Order(i) for i in range(start, start + 100)]:
+                    dispatch(order, Event('pay'))
+                    store.load(order.id)
+
+            threads = [
+                Thread(target=work, args=(start,))
+                for start in range(0, 400, 100)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            store.flush()
+            states = store.load_many(range(400))
+            self.assertEqual(set(states.values()), {'paid'})
+            self.assertEqual(len(states), 400)
+            store.close()
+
+    def test_nested(self):
+        m = NestedMachine('nested')
+        m.add_states([{'name': 'A', 'children': ['1', '2']}], initial='A.1')
+        m.add_region('flag', ['off', 'on'], 'off')
+        m.add_transition('A.1', 'A.2', 'go')
+        m.add_transition('flag.off', 'flag.on', 'go')
+        m.store = MemoryStore()
+        seen = []
+        # saved like in flat machines, once entered
+        m.get_state('A.2').on_enter = \
+            lambda state, event, instance, from_state: seen.append(
+                dict(m.store.states)
+            )
+
+        @state_machine('nested', machine_class=NestedMachine)
+        class Nested(object):
+
+            def __init__(self, id):
+                self.id = id
+        Nested.machine = m
+        n = Nested('n')
+        dispatch(n, Event('go'))
+        self.assertEqual(m.active_states(n), ('A.2', 'flag.on'))
+        self.assertEqual(m.store.states, {'n': 'A.2'})
+        self.assertEqual(seen, [{}])
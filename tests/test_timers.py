@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from threading import Thread
+from unittest import TestCase
+
+from yasm.core import Machine, state_machine
+from yasm.error import InvalidTransition
+from yasm.nested import NestedMachine
+from yasm.timers import TimerWheel
+from yasm.aio import run_timers
+from yasm.stores import MemoryStore
+from yasm.utils import dispatch
+
+from .helpers import Clock
+
+
+@state_machine('timers')
+class Stuff(object):
+    pass
+
+
+class TestTimers(TestCase):
+
+    def setUp(self):
+        self.clock = Clock(100.0)
+        m = Stuff.machine = Machine('timers')
+        m.add_state('idle')
+        m.add_state('busy', timeout=5)
+        m.add_state('done')
+        m.set_initial_state('busy')
+        m.timers = TimerWheel(resolution=1, size=8, clock=self.clock)
+        m.add_transition('busy', 'done', 'timeout')
+        m.add_transition('busy', 'idle', 'rest')
+        m.add_transition('idle', 'busy', 'work')
+
+    def test_timeout(self):
+        m = Stuff.machine
+        stuffs = [Stuff() for _ in range(3)]
+        self.assertEqual(len(m.timers), 3)
+        self.clock.now += 2
+        dispatch(stuffs[1], 'rest')
+        self.assertEqual(len(m.timers), 2)
+        self.assertEqual(m.tick(), 0)
+
+        self.clock.now += 2
+        dispatch(stuffs[1], 'work')
+        self.clock.now += 1
+        self.assertEqual(m.tick(), 2)
+        self.assertEqual(
+            [s.state for s in stuffs], ['done', 'busy', 'done']
+        )
+        self.clock.now += 3.5
+        self.assertEqual(m.tick(), 0)
+        self.clock.now += 1
+        self.assertEqual(m.tick(), 1)
+        self.assertEqual(stuffs[1].state, 'done')
+        self.assertEqual(len(m.timers), 0)
+
+    def test_long_timeouts(self):
+        m = Stuff.machine
+        m.set_timeout('busy', 20, 'expire')
+        m.add_transition('busy', 'idle', 'expire')
+        s = Stuff()
+        for _ in range(19):
+            self.clock.now += 1
+            self.assertEqual(m.tick(), 0)
+        # more than a whole round of the wheel at once
+        self.clock.now += 50
+        self.assertEqual(m.tick(), 1)
+        self.assertEqual(s.state, 'idle')
+
+    def test_clone(self):
+        m = Stuff.machine
+        mc = Stuff.machine = m.clone()
+        self.assertIs(mc.timers, m.timers)
+        mc.add_state('busy', force=True)
+        s = Stuff()
+        self.assertEqual(len(m.timers), 0)
+        self.assertEqual(m.timeouts['busy'], (5, 'timeout'))
+        self.assertNotIn('busy', mc.timeouts)
+        self.assertIs(type(mc.timeouts), dict)
+        Stuff.machine = m
+        s = Stuff()
+        self.assertEqual(len(m.timers), 1)
+        self.clock.now += 5
+        self.assertEqual(mc.tick(), 1)
+        self.assertEqual(s.state, 'done')
+
+    def test_nested(self):
+        m = NestedMachine('nested')
+        m.add_states([
+            {'name': 'A', 'children': ['1', '2']}, 'B',
+        ], initial='A.1')
+        m.timers = TimerWheel(resolution=1, clock=self.clock)
+        m.set_timeout('A', 3)
+        m.set_timeout('A.1', 1, 'next')
+        m.add_transition('A.1', 'A.2', 'next')
+        m.add_transition('A', 'B', 'timeout')
+
+        @state_machine('nested', machine_class=NestedMachine)
+        class Nested(object):
+            pass
+        Nested.machine = m
+        n = Nested()
+        self.assertEqual(len(m.timers), 2)
+        self.clock.now += 1
+        m.tick()
+        self.assertEqual(n.state, 'A.2')
+        self.assertEqual(len(m.timers), 1)
+        self.clock.now += 2
+        m.tick()
+        self.assertEqual(n.state, 'B')
+        self.assertEqual(len(m.timers), 0)
+
+    def test_reinit_and_hydrate(self):
+        m = Stuff.machine
+        s = Stuff()
+        s.id = 1
+        self.clock.now += 3
+        m.reinit_instance(s)
+        # restarted
+        self.clock.now += 3
+        self.assertEqual(m.tick(), 0)
+
+        m.store = MemoryStore()
+        m.store.save(1, 'idle')
+        m.hydrate([s])
+        self.assertEqual(len(m.timers), 0)
+        m.store.save(1, 'busy')
+        m.hydrate([s])
+        self.assertEqual(len(m.timers), 1)
+        self.clock.now += 5
+        self.assertEqual(m.tick(), 1)
+        self.assertEqual(s.state, 'done')
+
+    def test_failing_batch(self):
+        m = NestedMachine('nested')
+        m.add_states(['A', 'B', 'C'], initial='A')
+        m.timers = Stuff.machine.timers
+        m.set_timeout('A', 1)
+        m.add_transition('B', 'C', 'timeout')
+
+        @state_machine('nested', machine_class=NestedMachine)
+        class Nested(object):
+            pass
+        Nested.machine = m
+        n = Nested()
+        s = Stuff()
+        self.clock.now += 5
+        # A has no timeout transition, busy still times out
+        with self.assertRaises(InvalidTransition):
+            m.tick()
+        self.assertEqual(s.state, 'done')
+        self.assertEqual(n.state, 'A')
+        self.assertEqual(len(m.timers), 0)
+
+    def test_threads(self):
+        m = Stuff.machine
+        groups = [[Stuff() for _ in range(50)] for _ in range(4)]
+
+        def work(stuffs):
+            # every thread has its own instances, all share the wheel
+            for _ in range(200):
+                for s in stuffs:
+                    dispatch(s, 'rest' if s.state == 'busy' else 'work')
+                m.tick()
+
+        threads = [Thread(target=work, args=(group,)) for group in groups]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        busy = sum(s.state == 'busy' for group in groups for s in group)
+        self.assertEqual(len(m.timers), busy)
+
+    def test_run_timers(self):
+        m = Stuff.machine
+        m.timers = TimerWheel(resolution=0.01)
+        m.set_timeout('busy', 0.02)
+        s = Stuff()
+
+        async def main():
+            task = asyncio.ensure_future(run_timers(m.timers))
+            await asyncio.sleep(0.1)
+            task.cancel()
+        asyncio.run(main())
+        self.assertEqual(s.state, 'done')
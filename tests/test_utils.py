@@ -2,7 +2,7 @@ from unittest import TestCase
 
 from yasm.core import Event, state_machine
 from yasm import error
-from yasm.utils import on_event, get_event_handlers, dispatch
+from yasm.utils import on_event, get_event_handlers, dispatch, switch_to
 
 
 @state_machine('test')
@@ -38,3 +38,9 @@ class TestUtils(TestCase):
 
         dispatch(s, Event('__switch__', input='B'))
         self.assertEqual(s.state, 'B')
+
+        switch_to(s, 'D')
+        self.assertEqual(s.state, 'D')
+        with self.assertRaises(error.NoState):
+            switch_to(s, 'X')
+        self.assertEqual(s.state, 'D')
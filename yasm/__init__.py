@@ -24,20 +24,26 @@ Goals:
 
 .. |Machine| replace:: :class:`~yasm.Machine`
 .. |State| replace:: :class:`~yasm.State`
+.. |Transition| replace:: :class:`~yasm.Transition`
 .. |Hashable| replace:: :class:`~collections.Hashable`
 .. |Iterable| replace:: :class:`~collections.Iterable`
 .. |Callable| replace:: :class:`~collections.Callable`
 
 '''
 
-from .core import State, Machine, Event, state_machine
+from .core import State, Machine, Event, Transition, state_machine
 from .nested import NestedState, NestedMachine
-from .utils import on_event, add_state, add_states, dispatch
+from .utils import on_event, add_state, add_states, dispatch, switch_to
+from .utils import dispatch_many, feed, feed_inputs
+from .aio import adispatch
+from .guards import pure
 
 
 __all__ = [
     'state_machine', 'add_states', 'add_state', 'on_event', 'dispatch',
-    'State', 'Machine', 'Event', 'NestedState', 'NestedMachine',
+    'adispatch', 'dispatch_many', 'feed', 'feed_inputs', 'switch_to', 'pure',
+    'State', 'Machine', 'Event', 'Transition', 'NestedState',
+    'NestedMachine',
 ]
 
 __version__ = '0.1.0a1'
@@ -0,0 +1,182 @@
+'''asyncio support.
+
+:func:`adispatch` is the coroutine counterpart of :func:`~yasm.dispatch`:
+handlers, conditions, `before`/`after` and `on_enter`/`on_exit` callbacks
+may all be coroutine functions. :func:`run_timers` drives state timeouts
+and :func:`run_store` the writes of a buffering store.
+'''
+from asyncio import CancelledError, current_task, get_running_loop, sleep
+from collections import deque
+from inspect import isawaitable
+
+from .core import Event, _Records
+from .error import InvalidTransition, NoState
+
+
+class _Mailbox(object):
+    '''Run-to-completion queue of an instance dispatching asynchronously.'''
+
+    __slots__ = ('owner', 'waiters')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.waiters = deque()
+
+
+async def adispatch(instance, event, input=None):
+    '''Dispatch an event to a state machine, awaiting async callbacks.
+
+    Events dispatched to one instance run one at a time and in call order,
+    each to completion, concurrent tasks wait behind the running one. A
+    callback may dispatch to its own instance again, that call runs right
+    away like with :func:`~yasm.dispatch`.
+
+    When nothing is queued and all callbacks are synchronous the coroutine
+    completes without ever suspending.
+
+    :param event: Event to be dispatched, or an event name
+    :type event: :class:`.Event` or |Hashable|
+
+    :param input: input of the event when dispatching by name
+
+    '''
+    if not isinstance(event, Event):
+        event = instance.machine.EventClass(event, input)
+    task = current_task()
+    mailbox = instance.__dict__.get('_yasm_amailbox')
+    if mailbox is None:
+        mailbox = instance._yasm_amailbox = _Mailbox(task)
+    elif mailbox.owner is task:
+        # re-entrant dispatch from a callback
+        return await _dispatch(instance, event)
+    else:
+        await _wait_turn(instance, mailbox)
+        mailbox.owner = task
+    try:
+        await _dispatch(instance, event)
+    finally:
+        _next_turn(instance, mailbox)
+
+
+async def _wait_turn(instance, mailbox):
+    waiter = get_running_loop().create_future()
+    mailbox.waiters.append(waiter)
+    try:
+        await waiter
+    except CancelledError:
+        if waiter.cancelled():
+            mailbox.waiters.remove(waiter)
+        else:
+            # cancelled right after being handed the turn, pass it on
+            _next_turn(instance, mailbox)
+        raise
+
+
+def _next_turn(instance, mailbox):
+    # the next owner claims the mailbox once it resumes
+    mailbox.owner = None
+    waiters = mailbox.waiters
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+    del instance._yasm_amailbox
+
+
+async def _dispatch(instance, event):
+    machine = instance.machine
+    compiled = machine._compiled
+    if compiled is None:
+        compiled = machine.compile()._compiled
+    try:
+        state, records = compiled[instance._state_code]
+    except TypeError:
+        raise NoState(f'{instance} is not in any state')
+    for owner, handler in state._handler_chain(event):
+        if owner is not state and not event.propagate:
+            break
+        result = handler(owner, event, instance)
+        if isawaitable(result):
+            await result
+    records = records.get(event.name) or \
+        machine._fallback_records(state, event)
+    if not records and machine.regions and event.raise_invalid_transition:
+        # regions, which may have handled it, are not driven here
+        raise InvalidTransition(f'{state} cannot handle event {event}')
+    record = await _select(records, state, event, instance)
+    if record is None:
+        return
+    _, to_state, before, after, _ = record
+
+    if before:
+        if before.__class__ is str:
+            before = getattr(instance, before)
+        result = before(state, event, instance)
+        if isawaitable(result):
+            await result
+    machine._exiting(state, instance, to_state)
+    for exited in machine._exit_path(state, to_state):
+        result = exited.on_exit(exited, event, instance, to_state)
+        if isawaitable(result):
+            await result
+    instance._state_code = None
+    machine._entering(to_state, instance, state)
+    for entered in machine._enter_path(to_state, state):
+        result = entered.on_enter(entered, event, instance, state)
+        if isawaitable(result):
+            await result
+    machine._entered(to_state, instance)
+    if after:
+        if after.__class__ is str:
+            after = getattr(instance, after)
+        result = after(to_state, event, instance)
+        if isawaitable(result):
+            await result
+
+
+async def _select(records, state, event, instance):
+    '''Async :meth:`.Machine._select`, conditions may be coroutines.'''
+    if records.__class__ is _Records:
+        records = records.for_input(event.input)
+    for record in records:
+        for predicate, target, on_instance in record[0]:
+            if on_instance:
+                predicate = predicate(instance)
+                if callable(predicate):
+                    predicate = predicate(state, event, instance)
+            else:
+                predicate = predicate(state, event, instance)
+            if isawaitable(predicate):
+                predicate = await predicate
+            if predicate != target:
+                break
+        else:
+            return record
+    return None
+
+
+async def run_timers(timers, interval=None):
+    '''Tick a :class:`~yasm.timers.TimerWheel` forever, every `interval`
+    seconds, its resolution by default. Cancel the task to stop it.
+
+    Timeouts are dispatched synchronously, see :meth:`.Machine.tick`.
+    '''
+    interval = interval or timers.resolution
+    while True:
+        timers.tick()
+        await sleep(interval)
+
+
+async def run_store(store, interval=None):
+    '''Write the due changes of a :class:`~yasm.stores.SQLiteStore` forever,
+    every `interval` seconds, its `flush_interval` by default. Cancel the
+    task to stop it, pending changes are then flushed.
+    '''
+    interval = interval or store.flush_interval
+    try:
+        while True:
+            store.tick()
+            await sleep(interval)
+    finally:
+        store.flush()
@@ -1,92 +1,434 @@
-from collections import defaultdict
-from copy import deepcopy
+from collections import ChainMap
+from copy import copy
+from operator import attrgetter
+from types import MappingProxyType
 from six import string_types
 
 from .error import InvalidTransition
+from .error import FrozenMachine
 from .error import NoState
+from .error import NoStore
 from .error import InvalidState
 from .error import AlreadyHasState
 from .error import AlreadyHasInitialState
-from .utils import get_event_handlers
+from .guards import GuardCache, compile_guard, is_expression
+from .timers import TimerWheel
+
+
+def get_event_handlers(obj):
+    handlers = {}
+    for attr in dir(obj):
+        if attr.startswith('__'):
+            continue
+        value = getattr(obj, attr)
+        if getattr(value, 'on_event', ''):
+            handlers[value.on_event] = value
+    return handlers
 
 
 class Event(object):
 
+    __slots__ = (
+        'name', 'input', 'propagate', 'raise_invalid_transition', '_cargo'
+    )
+
     def __init__(self, name, input=None, propagate=True,
                  raise_invalid_transition=False, **cargo):
         self.name = name
         self.input = input
         self.propagate = propagate
         self.raise_invalid_transition = raise_invalid_transition
-        self.cargo = cargo
+        self._cargo = cargo or None
+
+    @property
+    def cargo(self):
+        '''Extra event data, the dict is only created when first used.'''
+        cargo = self._cargo
+        if cargo is None:
+            cargo = self._cargo = {}
+        return cargo
+
+    @cargo.setter
+    def cargo(self, cargo):
+        self._cargo = cargo
+
+    def _reuse(self, name, input):
+        '''Reset a pooled event, see :func:`~yasm.dispatch`.'''
+        self.name = name
+        self.input = input
+        self.propagate = True
+        self.raise_invalid_transition = False
+        self._cargo = None
 
     def __repr__(self):
-        return f'<Event {self.name}, input={self.input!r}, cargo={self.cargo}>'
+        return (
+            f'<Event {self.name}, input={self.input!r}, '
+            f'cargo={self._cargo or {}}>'
+        )
+
+
+def _noop_callback(state, event, instance, other_state):
+    pass
+
+
+def _class_callback(cls, name):
+    # the slot descriptor of `State` itself is not a callback
+    callback = getattr(cls, name)
+    return callback if callable(callback) else _noop_callback
+
+
+def _bumping(method):
+    def bump(self, *args, **kwargs):
+        Handlers.version += 1
+        return method(self, *args, **kwargs)
+    bump.__name__ = method.__name__
+    return bump
+
+
+class Handlers(dict):
+    '''The ``{event name: handler}`` of a state.
+
+    Every change bumps the class-wide :attr:`version`, so states caching
+    handlers, like :class:`~yasm.nested.NestedState`, know to refresh.
+    '''
+
+    __slots__ = ()
+
+    version = 0
+
+    __setitem__ = _bumping(dict.__setitem__)
+    __delitem__ = _bumping(dict.__delitem__)
+    if hasattr(dict, '__ior__'):
+        # ``|=`` is only there from Python 3.9
+        __ior__ = _bumping(dict.__ior__)
+    clear = _bumping(dict.clear)
+    pop = _bumping(dict.pop)
+    popitem = _bumping(dict.popitem)
+    setdefault = _bumping(dict.setdefault)
+    update = _bumping(dict.update)
 
 
 class State(object):
+    '''A state of a |Machine|.
+
+    `on_enter` and `on_exit` callbacks may be given per instance or defined
+    as methods of a subclass, they are called as
+    ``callback(state, event, instance, other_state)``.
+    '''
+
+    __slots__ = ('name', 'handlers', 'on_enter', 'on_exit')
+
+    # handlers declared with :func:`~yasm.on_event`, found once per class
+    class_handlers = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.class_handlers = get_event_handlers(cls)
 
     def __init__(self, name='', on_enter=None, on_exit=None):
-        self.name = name or self.__class__.__name__
-        self.handlers = get_event_handlers(self)
-        self.on_enter = on_enter or self.__class__.on_enter
-        self.on_exit = on_exit or self.__class__.on_exit
+        cls = self.__class__
+        self.name = name or cls.__name__
+        self.on_enter = on_enter or _class_callback(cls, 'on_enter')
+        self.on_exit = on_exit or _class_callback(cls, 'on_exit')
+        # a per-instance copy, so handlers can be overridden per state
+        self.handlers = Handlers(cls.class_handlers)
 
     def _on(self, event, instance):
         if event.name in self.handlers:
             self.handlers[event.name](self, event, instance)
 
-    def on_enter(self, event, instance, from_state):
-        pass
+    def _handler_chain(self, event):
+        '''The ``(state, handler)`` pairs :meth:`_on` calls for `event`.'''
+        handler = self.handlers.get(event.name)
+        return ((self, handler),) if handler else ()
 
-    def on_exit(self, event, instance, to_state):
-        pass
+    def _copy(self):
+        '''A shallow copy with its own handlers, see :meth:`Machine.clone`.'''
+        state = copy(self)
+        state.handlers = Handlers(self.handlers)
+        return state
 
     def __repr__(self):
         return f'<State {self.name}, handlers={self.handlers.keys()}>'
 
 
+class Transition(object):
+    '''A transition rule, see :meth:`Machine.add_transition`.
+
+    Items can also be read by key, like the dicts used in earlier versions.
+    '''
+
+    __slots__ = (
+        'from_state', 'to_state', 'event', 'conditions', 'before', 'after',
+        'inputs', 'pure',
+    )
+
+    def __init__(self, from_state, to_state, event, conditions,
+                 before=None, after=None, inputs=None, pure=False):
+        self.from_state = from_state
+        self.to_state = to_state
+        self.event = event
+        self.conditions = conditions
+        self.before = before
+        self.after = after
+        # frozenset of the event inputs accepted, None for any input
+        self.inputs = inputs
+        # whether the conditions only depend on state, event name and input
+        self.pure = pure
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return (
+            f'<Transition {self.from_state} -> {self.to_state} '
+            f'on {self.event!r}>'
+        )
+
+
 class Machine(object):
 
     StateClass = State
+    EventClass = Event
+    # orthogonal regions, see :meth:`.NestedMachine.add_region`
+    regions = ()
+    # number of selected transitions remembered, see :attr:`guard_cache`
+    GUARD_CACHE_SIZE = 4096
 
-    def __init__(self, name):
+    def __init__(self, name, concurrent=False, run_to_completion=False):
         self.name = name
+        # dispatch through per-instance mailboxes, see :func:`~yasm.dispatch`
+        self.concurrent = concurrent
+        # queue events dispatched from callbacks instead of recursing
+        self.run_to_completion = run_to_completion
         self.initial = None
         self.states = {}
-        self.transitions = defaultdict(list)
-        self.wildcard_transitions = defaultdict(list)
+        # dense integer code of every state, and the states by code
+        self.state_codes = {}
+        self.state_list = []
+        # whether `state_codes` and `state_list` are shared with a clone,
+        # see :meth:`clone`
+        self._shares_state_list = False
+        # {from_state: {event: [transition, ...]}}
+        self.transitions = {}
+        # {event: [transition, ...]}
+        self.wildcard_transitions = {}
+        self.frozen = False
+        self._compiled = None
+        # whether `_compiled` is shared with a clone, see :meth:`clone`
+        self._shares_compiled = False
+        self._compiled_wildcards = {}
+        # spare events for dispatching by event name
+        self._event_pool = []
+        # transitions selected by pure guards, see :func:`~yasm.pure`
+        self.guard_cache = GuardCache(self.GUARD_CACHE_SIZE)
+        # {state: (timeout, event)}, see :meth:`set_timeout`
+        self.timeouts = {}
+        # whether `timeouts` is shared with a clone, see :meth:`clone`
+        self._shares_timeouts = False
+        # :class:`~yasm.timers.TimerWheel` created with the first timeout
+        self.timers = None
+        # :class:`~yasm.stores.StateStore` saving the states entered, once
+        # their `on_enter` callbacks ran
+        self.store = None
 
     def _create_state(self, name, *args, **kwargs):
         return self.StateClass(name, *args, **kwargs)
 
     def _get_transition(self, state, event, instance):
-        transitions = self.transitions[(state.name, event.name)]
-        if not transitions and event.raise_invalid_transition:
+        if self._compiled is None:
+            self.compile()
+        records = self._compiled[self.state_codes[state.name]][1]
+        records = records.get(event.name) or \
+            self._fallback_records(state, event)
+        record = self._select(records, state, event, instance)
+        return record and record[4]
+
+    def _compile_transition(self, transition):
+        '''Turn a |Transition| into a dispatch record.
+
+        A record is a ``(guards, to_state, before, after, transition)`` tuple,
+        each guard is a ``(predicate, target, on_instance)`` tuple, string
+        conditions are resolved to :func:`operator.attrgetter`, string
+        callbacks naming a method are kept and looked up on the instance by
+        the dispatchers, dotted ones are bound to a getter once.
+
+        Transitions restricted to some `inputs` get an input check as first
+        guard, see :func:`_index_records`.
+
+        Return None if a constant condition can never be met.
+        '''
+        guards = []
+        inputs = transition.inputs
+        if inputs is not None:
+            if not inputs:
+                return None
+            guards.append((_input_guard(inputs), True, False))
+        for cond, target in transition.conditions:
+            if isinstance(cond, list):
+                guards.append((attrgetter('.'.join(cond)), target, True))
+            elif callable(cond):
+                guards.append((cond, target, False))
+            elif cond != target:
+                return None
+        return (
+            tuple(guards),
+            self.states[transition.to_state],
+            _bind_callback(transition.before),
+            _bind_callback(transition.after),
+            transition,
+        )
+
+    def _missing_transitions(self, state, event):
+        '''Called when `state` has no transitions registered for `event`.'''
+        if event.raise_invalid_transition:
             raise InvalidTransition(f'{state} cannot handle event {event}')
-        for transition in transitions:
-            for cond, target in transition['conditions']:
-                if isinstance(cond, list):
-                    predicate = instance
-                    for pre in cond:
-                        predicate = getattr(predicate, pre)
+        return ()
+
+    def _fallback_records(self, state, event):
+        '''Records to try when `state` has none of its own for `event`.'''
+        if event.name == '__switch__':
+            # legacy spelling of :meth:`switch_to`
+            to_state = self.states.get(event.input)
+            if to_state is None:
+                return ()
+            return (((), to_state, None, None, None),)
+        return self._wildcards_of(state).get(event.name) or \
+            self._missing_transitions(state, event)
+
+    def _wildcards_of(self, state):
+        '''The compiled ``{event: records}`` of the wildcard transitions
+        that apply to `state`.
+        '''
+        return self._compiled_wildcards
+
+    def _select(self, records, state, event, instance):
+        '''Return the first dispatch record whose guards all pass.
+
+        `records` are the candidates of `state` for `event`, that is the
+        compiled records of the state or :meth:`_fallback_records`.
+        '''
+        if records.__class__ is _Records:
+            return self._select_indexed(records, state, event, instance)
+        for record in records:
+            for predicate, target, on_instance in record[0]:
+                if on_instance:
+                    predicate = predicate(instance)
+                    if callable(predicate):
+                        predicate = predicate(state, event, instance)
                 else:
-                    predicate = cond
-                if callable(predicate):
                     predicate = predicate(state, event, instance)
                 if predicate != target:
                     break
             else:
-                return transition
+                return record
         return None
 
+    def _select_indexed(self, records, state, event, instance):
+        ''':meth:`_select` for records indexed by :func:`_index_records`.
+
+        When all guards are pure, the record selected for a state, event
+        name and input is remembered in :attr:`guard_cache`.
+        '''
+        candidates = records.for_input(event.input)
+        if not records.pure:
+            return self._select(candidates, state, event, instance)
+        cache = self.guard_cache
+        key = (state.name, event.name, event.input)
+        record = cache.get(key, _MISSING)
+        if record is _MISSING:
+            record = self._select(candidates, state, event, instance)
+            cache.put(key, record)
+        return record
+
+    def _apply(self, record, state, event, instance):
+        '''Run the transition described by a dispatch record.'''
+        _, to_state, before, after, _ = record
+        if before:
+            if before.__class__ is str:
+                before = getattr(instance, before)
+            before(state, event, instance)
+        self._exit_state(state, event, instance, to_state)
+        self._enter_state(to_state, event, instance, state)
+        if after:
+            if after.__class__ is str:
+                after = getattr(instance, after)
+            after(to_state, event, instance)
+
     def _enter_state(self, state, event, instance, from_state):
-        state.on_enter(state, event, instance, from_state)
-        instance.state = state.name
+        # a flat machine only needs its hooks when states have timeouts
+        if self.timeouts:
+            self._entering(state, instance, from_state)
+        on_enter = state.on_enter
+        if on_enter is not _noop_callback:
+            on_enter(state, event, instance, from_state)
+        # :meth:`_entered`, inlined on the hot path
+        instance._state_code = self.state_codes[state.name]
+        if self.store is not None:
+            self._save_state(instance, state)
 
     def _exit_state(self, state, event, instance, to_state):
-        state.on_exit(state, event, instance, to_state)
-        instance.state = None
+        if self.timeouts:
+            self._exiting(state, instance, to_state)
+        on_exit = state.on_exit
+        if on_exit is not _noop_callback:
+            on_exit(state, event, instance, to_state)
+        instance._state_code = None
+
+    # The bookkeeping of a transition, apart from the callbacks. Shared
+    # with :func:`~yasm.aio.adispatch`, which awaits the callbacks in
+    # between.
+
+    def _exiting(self, state, instance, to_state):
+        '''Called before the `on_exit` callbacks of `state`.'''
+        if self.timeouts:
+            for exited in self._exit_path(state, to_state):
+                self.timers.cancel(instance, exited.name)
+
+    def _entering(self, state, instance, from_state):
+        '''Called before the `on_enter` callbacks of `state`.'''
+        if self.timeouts:
+            for entered in self._enter_path(state, from_state):
+                self._arm_timeout(entered, instance)
+
+    def _entered(self, state, instance):
+        '''Called after the `on_enter` callbacks of `state`.'''
+        instance._state_code = self.state_codes[state.name]
+        if self.store is not None:
+            self._save_state(instance, state)
+
+    def _keeps_records(self):
+        '''Whether the hooks above have anything to do.'''
+        return bool(self.timeouts) or self.store is not None
+
+    def _save_state(self, instance, state):
+        store = self.store
+        store.save(store.key(instance), state.name)
+
+    def _move_timers(self, instance, from_state, to_state):
+        '''Cancel the timeouts of `from_state` and arm those of `to_state`,
+        for instances moved without a transition.
+        '''
+        for exited in self._exit_path(from_state, to_state):
+            self.timers.cancel(instance, exited.name)
+        for entered in self._enter_path(to_state, from_state):
+            self._arm_timeout(entered, instance)
+
+    def _arm_timeout(self, state, instance):
+        timeout = self.timeouts.get(state.name)
+        if timeout is not None:
+            self.timers.arm(instance, state.name, *timeout)
+
+    def _exit_path(self, state, to_state):
+        '''States whose `on_exit` runs leaving `state` for `to_state`.'''
+        return (state,)
+
+    def _enter_path(self, state, from_state):
+        '''States whose `on_enter` runs entering `state` from `from_state`.'''
+        return (state,)
 
     def _init_instance(self, instance):
         '''Initialize states in the state machine.
@@ -97,15 +439,31 @@ class Machine(object):
         Note: should not called from outside, this method would reset instance
         attributes
         '''
-        state = self.get_state(self.initial)
-        instance.state = state.name
+        state = self._get_state(self.initial)
+        instance._state_code = self.state_codes[state.name]
+        if self.timeouts:
+            self._arm_timeout(state, instance)
         state.on_enter(state, Event('initialize'), instance, None)
 
     def _reset(self):
         self.initial = None
         self.states = {}
-        self.transitions = defaultdict(list)
-        self.wildcard_transitions = defaultdict(list)
+        self.state_codes = {}
+        self.state_list = []
+        self._shares_state_list = False
+        self.transitions = {}
+        self.wildcard_transitions = {}
+        self.frozen = False
+        self._compiled = None
+        self._compiled_wildcards = {}
+        self.guard_cache.clear()
+        self.timeouts = {}
+        self._shares_timeouts = False
+        self.timers = None
+
+    def _check_frozen(self):
+        if self.frozen:
+            raise FrozenMachine(f'{self} is frozen')
 
     def _validate_add_state(self, state_name, state, force):
         if not isinstance(state, State):
@@ -128,19 +486,20 @@ class Machine(object):
             )
 
     def _prepare_transition(self, from_state, to_state, event,
-                            conditions=None, before=None, after=None):
+                            conditions=None, before=None, after=None,
+                            inputs=None, pure=False):
         _conditions = []
         if conditions is not None:
             if not isinstance(conditions, list):
                 conditions = [conditions]
         else:
             conditions = []
-        if from_state == '*' and event == '__switch__':
-            conditions.append(
-                lambda state, event, instance: event.input == to_state
-            )
         for cond in conditions:
-            if isinstance(cond, string_types):
+            if isinstance(cond, string_types) and is_expression(cond):
+                if cond.startswith('!'):
+                    cond = f'not ({cond[1:]})'
+                predicate, target = compile_guard(cond), True
+            elif isinstance(cond, string_types):
                 if cond.startswith('!'):
                     predicate, target = cond[1:].split('.'), False
                 else:
@@ -148,29 +507,167 @@ class Machine(object):
             else:
                 predicate, target = cond, True
             _conditions.append((predicate, target))
-        return {
-            'from_state': from_state,
-            'to_state': to_state,
-            'conditions': _conditions,
-            'before': before,
-            'after': after,
-        }
+        if inputs is not None:
+            # a string stands for the set of its characters
+            inputs = frozenset(inputs)
+        return Transition(
+            from_state, to_state, event, _conditions, before, after, inputs,
+            pure,
+        )
 
     def clone(self):
-        ins = self.__class__(self.name)
-        ins.name = self.name
+        '''Return a copy of the machine that can be changed independently.
+
+        Nothing is copied up front. The state and transition tables become
+        layered maps whose current contents are shared by both machines,
+        each machine writes to its own top layer and only copies the
+        entries it changes. State objects are copied the first time either
+        machine returns them from :meth:`get_state`, so changing the
+        `handlers` or callbacks of one does not affect the other. Get
+        states again after cloning rather than keeping earlier references.
+
+        The tables read on every dispatch, :attr:`state_codes` and
+        :attr:`timeouts`, stay plain dicts shared until either machine
+        changes them, which copies them whole.
+        '''
+        ins = self.__class__(
+            self.name, self.concurrent, self.run_to_completion
+        )
         ins.initial = self.initial
-        ins.states = deepcopy(self.states)
-        ins.transitions = deepcopy(self.transitions)
-        ins.wildcard_transitions = deepcopy(self.wildcard_transitions)
+        for attr in ('states', 'transitions', 'wildcard_transitions'):
+            shared = getattr(self, attr)
+            setattr(self, attr, _fork(shared))
+            setattr(ins, attr, _fork(shared))
+        ins.state_codes = self.state_codes
+        ins.state_list = self.state_list
+        self._shares_state_list = ins._shares_state_list = True
+        ins.timeouts = self.timeouts
+        self._shares_timeouts = ins._shares_timeouts = True
+        ins._compiled = self._compiled
+        self._shares_compiled = ins._shares_compiled = True
+        ins._compiled_wildcards = self._compiled_wildcards
+        # armed timers are found by instance, both machines can share them
+        ins.timers = self.timers
+        ins.regions = self.regions
+        ins.store = self.store
         return ins
 
-    def add_state(self, name, state=None, force=False):
+    def compile(self):
+        '''Precompute the dispatch table used by :func:`~yasm.dispatch`.
+
+        The table is a list indexed by state code (see :attr:`state_codes`)
+        of ``(state, records)`` pairs, where
+        `records` maps event names to a tuple of dispatch records, see
+        :meth:`_compile_transition`. It is built lazily on first dispatch
+        and dropped whenever states change, new transitions only recompile
+        the states they affect.
+
+        Wildcard transitions are compiled once and only merged into the
+        states that also have their own transitions for the same event,
+        other states fall back to them on lookup.
+        '''
+        self._compiled_wildcards = {
+            event: _index_records(self._compile_transitions(transitions))
+            for event, transitions in self.wildcard_transitions.items()
+        }
+        compiled = [None] * len(self.state_list)
+        for state in self._compile_order():
+            compiled[self.state_codes[state.name]] = (
+                state, self._compile_state(state, compiled)
+            )
+        # published only once complete, concurrent dispatchers either see
+        # no table and compile their own or see a finished one
+        self._compiled = compiled
+        self._shares_compiled = False
+        self.guard_cache.clear()
+        return self
+
+    def _compile_order(self):
+        return self.state_list
+
+    def _compile_state(self, state, compiled):
+        '''Return the compiled ``{event: records}`` mapping of `state`.
+
+        `compiled` is the table being built, filled in :meth:`_compile_order`.
+        '''
+        events = self.transitions.get(state.name)
+        if not events:
+            return _NO_RECORDS
+        wildcards = self._wildcards_of(state)
+        return {
+            event: _index_records(
+                self._compile_transitions(transitions) +
+                wildcards.get(event, ())
+            )
+            for event, transitions in events.items()
+        }
+
+    def _affected_states(self, state):
+        '''States whose compiled records depend on those of `state`.'''
+        return (state,)
+
+    def _update_compiled(self, from_state):
+        '''Recompile what a new transition from `from_state` changes.'''
+        compiled = self._compiled
+        if compiled is None:
+            return
+        # cached selections may refer to replaced records
+        self.guard_cache.clear()
+        if from_state == '*':
+            # wildcards are merged into every state
+            self._compiled = None
+            return
+        if self._shares_compiled:
+            compiled = self._compiled = list(compiled)
+            self._shares_compiled = False
+        states, codes = self.states, self.state_codes
+        for state in self._affected_states(states[from_state]):
+            if states.get(state.name) is state:
+                compiled[codes[state.name]] = (
+                    state, self._compile_state(state, compiled)
+                )
+
+    def _compile_transitions(self, transitions):
+        records = []
+        for transition in transitions:
+            record = self._compile_transition(transition)
+            if record is not None:
+                records.append(record)
+        return tuple(records)
+
+    def freeze(self):
+        '''Compile the machine and forbid any further changes to it.
+
+        Adding states or transitions to a frozen machine raises
+        :class:`~yasm.error.FrozenMachine`, :meth:`clone` it instead.
+        '''
+        self.compile()
+        self.frozen = True
+        return self
+
+    def add_state(self, name, state=None, force=False, timeout=None,
+                  on_timeout_event='timeout'):
+        '''Add a state to the machine.
+
+        :param timeout: (Optional) seconds after which an instance still in
+            the state is sent `on_timeout_event`, see :meth:`set_timeout`
+        :type timeout: |float|
+        '''
+        self._check_frozen()
         state = state or self._create_state(name)
         self._validate_add_state(name, state, force)
+        self.set_timeout(name, timeout, on_timeout_event)
         self.states[name] = state
-        # for internal use only
-        self.add_transition('*', name, '__switch__')
+        if self._shares_state_list:
+            self.state_codes = dict(self.state_codes)
+            self.state_list = list(self.state_list)
+            self._shares_state_list = False
+        code = self.state_codes.setdefault(name, len(self.state_list))
+        if code == len(self.state_list):
+            self.state_list.append(state)
+        else:
+            self.state_list[code] = state
+        self._compiled = None
 
     def add_states(self, states, initial=None, force=False):
         for state in states:
@@ -187,24 +684,89 @@ class Machine(object):
         if initial:
             self.set_initial_state(initial, force=force)
 
+    def set_timeout(self, state_name, timeout, on_timeout_event='timeout'):
+        '''Leave `state_name` after `timeout` seconds.
+
+        Entering the state arms a timer, leaving it cancels the timer. Once
+        expired and :meth:`tick` is called, an `on_timeout_event` event is
+        dispatched to the instance, with the state name as input. Add the
+        transitions for that event as usual, `timeout` None removes the
+        timeout.
+        '''
+        self._check_frozen()
+        if timeout is None and state_name not in self.timeouts:
+            return
+        if self._shares_timeouts:
+            self.timeouts = dict(self.timeouts)
+            self._shares_timeouts = False
+        if timeout is None:
+            del self.timeouts[state_name]
+            return
+        self.timeouts[state_name] = (timeout, on_timeout_event)
+        if self.timers is None:
+            self.timers = TimerWheel()
+
+    def tick(self, now=None):
+        '''Fire expired timeouts, see :meth:`.TimerWheel.tick`, and write
+        the changes of :attr:`store` that are due.
+
+        Call it periodically, e.g. from a scheduler or with
+        :func:`yasm.aio.run_timers`. Machines sharing a :attr:`timers` wheel
+        only need one of them ticked.
+        '''
+        if self.store is not None:
+            self.store.tick()
+        if self.timers is None:
+            return 0
+        return self.timers.tick(now)
+
     def has_state(self, state_name):
         return state_name in self.states
 
     def get_state(self, state_name):
+        '''Return the state `state_name`, for reading or changing it.
+
+        A state still shared with a clone is copied first, see
+        :meth:`clone`.
+        '''
+        state = self._get_state(state_name)
+        states = self.states
+        if isinstance(states, ChainMap) and state_name not in states.maps[0]:
+            self._own_state(state)
+            state = states[state_name]
+        return state
+
+    def _get_state(self, state_name):
         if state_name not in self.states:
             raise NoState(f'{self} has no such state: {state_name}')
         return self.states[state_name]
 
+    def _own_state(self, state):
+        '''Replace `state`, shared with a clone, with a copy of its own.'''
+        self._replace_states([state._copy()])
+
+    def _replace_states(self, states):
+        if self._shares_state_list:
+            self.state_codes = dict(self.state_codes)
+            self.state_list = list(self.state_list)
+            self._shares_state_list = False
+        for state in states:
+            self.states[state.name] = state
+            self.state_list[self.state_codes[state.name]] = state
+        self._compiled = None
+
     def set_initial_state(self, state_name, force=False):
         if isinstance(state_name, State):
             state_name = state_name.name
         elif isinstance(state_name, type) and issubclass(state_name, State):
             state_name = state_name.__name__
+        self._check_frozen()
         self._validate_initial_state(state_name, force)
         self.initial = state_name
 
     def add_transition(self, from_state, to_state, event,
-                       conditions=None, before=None, after=None):
+                       conditions=None, before=None, after=None,
+                       inputs=None, pure=False):
         '''Add a transition to a state machine.
 
         All callbacks take two arguments - `state` and `event`. See parameters
@@ -228,7 +790,9 @@ class Machine(object):
         :type event: |string|
 
         :param conditions: Condition callback - if all returns `True`
-            transition may be initiated.
+            transition may be initiated. A string is either an attribute
+            path of the instance or a guard expression, see
+            :mod:`yasm.guards`, both negated with a ``!`` prefix.
 
             `condition` callback takes two arguments:
 
@@ -253,18 +817,38 @@ class Machine(object):
                 - event: Event that triggered the transition
         :type after: |Callable|
 
+        :param inputs: (Optional) values of ``event.input`` the transition
+            accepts, a string accepts each of its characters. Transitions
+            are indexed by input, so selecting them costs a single lookup
+            instead of a condition call each.
+        :type inputs: |Iterable| or |string|
+
+        :param pure: (Optional) whether all `conditions` only depend on the
+            state, the event name and the event input, so their outcome can
+            be cached, see :func:`~yasm.pure`
+        :type pure: |bool|
+
         '''
+        self._check_frozen()
         self._validate_transition(from_state, to_state, event)
         transition = self._prepare_transition(
-            from_state, to_state, event, conditions, before, after
+            from_state, to_state, event, conditions, before, after, inputs,
+            pure,
         )
         if from_state == '*':
-            transitions = self.wildcard_transitions[event]
-            transitions.append(transition)
-            for from_state in self.states:
-                self.transitions[(from_state, event)] = transitions
+            transitions = self.wildcard_transitions
         else:
-            self.transitions[(from_state, event)].append(transition)
+            transitions = _own(self.transitions, from_state, _copy_events)
+        _own(transitions, event, list).append(transition)
+        self._update_compiled(from_state)
+
+    def get_transitions(self, state_name, event):
+        '''Return the transitions registered for `state_name` and `event`.
+
+        Wildcard transitions are not included. Lookups never modify the
+        transition table, unknown pairs give an empty tuple.
+        '''
+        return self.transitions.get(state_name, _NO_RECORDS).get(event, ())
 
     def add_transitions(self, transitions):
         for transition in transitions:
@@ -273,20 +857,366 @@ class Machine(object):
             elif isinstance(transition, dict):
                 self.add_transition(**transition)
 
+    def switch_to(self, instance, state_name, event=None):
+        '''Force `instance` into `state_name` without a transition rule.
+
+        The target state is looked up directly and the usual exit/enter
+        callbacks are run, no conditions or before/after callbacks are
+        involved.
+
+        :param event: (Optional) event passed to the exit/enter callbacks,
+            defaults to ``Event('__switch__', input=state_name)``
+        :type event: :class:`.Event`
+        '''
+        state = self._get_state(instance.state)
+        to_state = self._get_state(state_name)
+        if event is None:
+            event = Event('__switch__', input=state_name)
+        self._exit_state(state, event, instance, to_state)
+        self._enter_state(to_state, event, instance, state)
+
+    def build(self, states, transitions=(), initial=None, force=False):
+        '''Add `states` and `transitions` in bulk and compile the machine.
+
+        Accepts the same formats as :meth:`add_states` and
+        :meth:`add_transitions`. Every state and transition is validated and
+        indexed once, and the dispatch table is compiled once at the end, so
+        the cost grows linearly with the size of the machine.
+
+        :returns: the machine itself
+        '''
+        self.add_states(states, initial, force)
+        self.add_transitions(transitions)
+        return self.compile()
+
+    def scan(self, instance, text, event='parse', stop_states=()):
+        '''Dispatch `event` for every item of `text`, e.g. to tokenise it.
+
+        Works best with transitions keyed by input, see :meth:`add_transition`
+        with `inputs`, a ``bytes`` or ``memoryview`` buffer gives ``int``
+        items. The records of every state are resolved once per scan and a
+        transition from a state to itself without `on_exit`/`on_enter`
+        callbacks only runs its `before`/`after` actions.
+
+        A single event object is reused for the whole buffer, only its
+        `input` changes, so callbacks must not keep references to it. Only
+        the main state is driven, not orthogonal regions.
+
+        With :attr:`concurrent` or :attr:`run_to_completion` set, every item
+        is dispatched as a new event with :func:`~yasm.dispatch` instead.
+
+        :param text: the buffer to scan
+        :type text: |string|, ``bytes`` or ``memoryview``
+
+        :param stop_states: names of states at which scanning stops
+        :type stop_states: |Iterable|
+
+        :returns: offset of the first item not consumed
+        '''
+        stop_codes = self._stop_codes(stop_states)
+        if self.concurrent or self.run_to_completion:
+            # imported here, utils depends on this module
+            from .utils import _feed_dispatching
+            events = (self.EventClass(event, input) for input in text)
+            return _feed_dispatching(instance, events, stop_codes)
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self.compile()._compiled
+        event = self.EventClass(event)
+        select = self._select
+        # {state code: (state, records, records by input, handled, quiet)}
+        entries = {}
+
+        offset = 0
+        for input in text:
+            code = instance._state_code
+            if code in stop_codes:
+                break
+            entry = entries.get(code)
+            if entry is None:
+                entry = entries[code] = self._scan_entry(
+                    compiled, code, event, instance
+                )
+            state, records, by_input, handled, quiet = entry
+            offset += 1
+            event.input = input
+            if handled:
+                state._on(event, instance)
+            if by_input is not None:
+                records = by_input.get(input, records)
+            if not records:
+                continue
+            record = records[0]
+            if record[0]:
+                record = select(records, state, event, instance)
+                if record is None:
+                    continue
+            _, to_state, before, after, _ = record
+
+            if before:
+                if before.__class__ is str:
+                    before = getattr(instance, before)
+                before(state, event, instance)
+            if to_state is not state or not quiet:
+                self._exit_state(state, event, instance, to_state)
+                self._enter_state(to_state, event, instance, state)
+            if after:
+                if after.__class__ is str:
+                    after = getattr(instance, after)
+                after(to_state, event, instance)
+        return offset
+
+    def _scan_entry(self, compiled, code, event, instance):
+        '''What :meth:`scan` needs to know about the state of `code`.'''
+        try:
+            state, records = compiled[code]
+        except TypeError:
+            raise NoState(f'{instance} is not in any state')
+        records = records.get(event.name) or \
+            self._fallback_records(state, event)
+        by_input = None
+        if records.__class__ is _Records:
+            records, by_input = records.default, records.by_input
+        quiet = not self._keeps_records() and all(
+            exited.on_exit is _noop_callback
+            for exited in self._exit_path(state, state)
+        ) and all(
+            entered.on_enter is _noop_callback
+            for entered in self._enter_path(state, state)
+        )
+        return (
+            state, records, by_input, bool(state._handler_chain(event)),
+            quiet,
+        )
+
+    def _stop_codes(self, stop_states):
+        try:
+            return {self.state_codes[name] for name in stop_states}
+        except KeyError as ex:
+            raise NoState(f'{self} has no such state: {ex.args[0]}')
+
     def reinit_instance(self, instance):
-        state = self.get_state(self.initial)
-        instance.state = state.name
+        '''Put `instance` back in the initial state, without running any
+        transition, and forget its stored state, see :attr:`store`.
+        '''
+        state = self._get_state(self.initial)
+        if self.timeouts and instance._state_code is not None:
+            self._move_timers(
+                instance, self.state_list[instance._state_code], state
+            )
+        instance._state_code = self.state_codes[state.name]
+        store = self.store
+        if store is not None:
+            # like a new instance, see :mod:`yasm.stores`
+            store.delete(store.key(instance))
         state._on(Event('reinit'), instance)
 
+    def hydrate(self, instances):
+        '''Restore the states of `instances` saved in :attr:`store`.
+
+        States are loaded in bulk and set without running any callback,
+        instances without a saved state keep theirs. Timeouts of the
+        previous states are cancelled and those of the restored ones armed
+        anew. Without a :attr:`store` :class:`~yasm.error.NoStore` is
+        raised.
+
+        :returns: number of instances restored
+        '''
+        store = self.store
+        if store is None:
+            raise NoStore(f'{self} has no store')
+        instances = {store.key(instance): instance for instance in instances}
+        states = store.load_many(instances)
+        codes, state_list = self.state_codes, self.state_list
+        for key, state_name in states.items():
+            try:
+                code = codes[state_name]
+            except KeyError:
+                raise NoState(f'{self} has no such state: {state_name}')
+            instance = instances[key]
+            if self.timeouts and instance._state_code is not None:
+                self._move_timers(
+                    instance, state_list[instance._state_code],
+                    state_list[code],
+                )
+            instance._state_code = code
+        return len(states)
+
     def __repr__(self):
         return f'<Machine: {self.name}, states: {self.states.keys()}>'
 
 
+# layered maps deeper than this are flattened by the next clone
+_MAX_LAYERS = 8
+
+
+def _fork(mapping):
+    '''Put a new, empty, writable layer on top of `mapping`.'''
+    if not isinstance(mapping, ChainMap):
+        return ChainMap({}, mapping)
+    maps = mapping.maps
+    if not maps[0]:
+        maps = maps[1:]
+    if len(maps) >= _MAX_LAYERS:
+        maps = [dict(mapping)]
+    return ChainMap({}, *maps)
+
+
+def _own(mapping, key, copy):
+    '''Return `mapping[key]` for writing.
+
+    The value is created with ``copy()`` if missing, or copied with
+    ``copy(value)`` if it lives in a layer shared with another machine.
+    '''
+    if isinstance(mapping, ChainMap):
+        layer = mapping.maps[0]
+        if key not in layer:
+            layer[key] = copy(mapping[key]) if key in mapping else copy()
+        return layer[key]
+    if key not in mapping:
+        mapping[key] = copy()
+    return mapping[key]
+
+
+def _copy_events(events=None):
+    if events is None:
+        return {}
+    return {event: list(transitions) for event, transitions in events.items()}
+
+
+# shared by every state without transitions, never mutated
+_NO_RECORDS = MappingProxyType({})
+
+
+def _input_guard(inputs):
+    def accepts(state, event, instance):
+        try:
+            return event.input in inputs
+        except TypeError:
+            # unhashable input
+            return False
+    accepts.pure = True
+    return accepts
+
+
+# a guard cache miss, None is a cached "no transition"
+_MISSING = object()
+
+
+class _Records(tuple):
+    '''Dispatch records of one event, with what is known to select them.
+
+    The tuple holds all records in order. If some transitions only accept
+    some inputs, `by_input` maps every input they name to the records it
+    may select, without their input guard, and `default` holds the records
+    accepting any input. `pure` tells whether the selection can be cached,
+    see :meth:`Machine._select_indexed`.
+    '''
+
+    def for_input(self, input):
+        by_input = self.by_input
+        if by_input is None:
+            return self.default
+        try:
+            return by_input.get(input, self.default)
+        except TypeError:
+            return self.default
+
+
+def _is_pure(record):
+    transition = record[4]
+    return transition.pure or all(
+        not on_instance and getattr(predicate, 'pure', False) is True
+        for predicate, _, on_instance in record[0]
+    )
+
+
+def _index_records(records):
+    '''Index `records` by input and mark whether their guards are pure.'''
+    keyed = any(record[4].inputs is not None for record in records)
+    # caching only pays off if there are guards besides input checks
+    pure = any(
+        len(record[0]) > (record[4].inputs is not None) for record in records
+    ) and all(_is_pure(record) for record in records)
+    if not keyed and not pure:
+        return records
+    indexed = _Records(records)
+    indexed.pure = pure
+    if not keyed:
+        indexed.by_input = None
+        indexed.default = records
+        return indexed
+    # records accepting any input, in order
+    default = []
+    by_input = {}
+    for record in records:
+        inputs = record[4].inputs
+        if inputs is None:
+            default.append(record)
+            for selected in by_input.values():
+                selected.append(record)
+            continue
+        unguarded = (record[0][1:],) + record[1:]
+        for input in inputs:
+            selected = by_input.get(input)
+            if selected is None:
+                selected = by_input[input] = list(default)
+            selected.append(unguarded)
+    indexed.by_input = {
+        input: tuple(selected) for input, selected in by_input.items()
+    }
+    indexed.default = tuple(default)
+    return indexed
+
+
+def _bind_callback(callback):
+    if isinstance(callback, string_types) and callback.isidentifier():
+        # a plain name is looked up on the instance by the dispatchers
+        # themselves, saving a call per transition
+        return callback
+    if isinstance(callback, string_types):
+        getter = attrgetter(callback)
+
+        def named_callback(state, event, instance):
+            return getter(instance)(state, event, instance)
+        return named_callback
+    return callback or None
+
+
+class StateAttribute(object):
+    '''Data descriptor backing ``instance.state``.
+
+    The instance only keeps the integer code of its current state, see
+    :attr:`Machine.state_codes`, reading the attribute still gives the state
+    name. The machine itself writes the code directly.
+    '''
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        code = instance.__dict__.get('_state_code')
+        if code is None:
+            return None
+        return instance.machine.state_list[code].name
+
+    def __set__(self, instance, state_name):
+        if state_name is None:
+            instance.__dict__['_state_code'] = None
+            return
+        machine = instance.machine
+        try:
+            code = machine.state_codes[state_name]
+        except KeyError:
+            raise NoState(f'{machine} has no such state: {state_name}')
+        instance.__dict__['_state_code'] = code
+
+
 def state_machine(name, machine_class=None):
 
     def wrapper(cls):
         cls.initiated_yasm = True
         cls.machine = (machine_class or Machine)(name)
+        cls.state = StateAttribute()
 
         original_init = cls.__init__
 
@@ -21,3 +21,15 @@ class AlreadyHasInitialState(PysmError):
 
 class InvalidTransition(PysmError):
     pass
+
+
+class FrozenMachine(PysmError):
+    pass
+
+
+class InvalidCondition(PysmError):
+    pass
+
+
+class NoStore(PysmError):
+    pass
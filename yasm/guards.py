@@ -0,0 +1,170 @@
+'''Guard expressions.
+
+A transition condition may be given as a small Python expression over
+`state`, `event` and `instance`, e.g.
+``"instance.balance > 0 and event.input in ('a', 'b')"``. It is checked
+and compiled to a plain function once, when the transition is added.
+
+Only literals, attribute access, subscripts and boolean, comparison and
+arithmetic operators are allowed, names other than the three above,
+calls and private attributes are rejected.
+
+Guards that only depend on the state, the event name and the event input
+can be marked :func:`pure`, the transitions they select are then cached
+per machine in a :class:`GuardCache`.
+'''
+import ast
+import re
+from collections import OrderedDict
+
+from .error import InvalidCondition
+
+
+# the names a guard expression can refer to
+GUARD_ARGS = ('state', 'event', 'instance')
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.FloorDiv, ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+    ast.Gt, ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot, ast.IfExp,
+    ast.Name, ast.Attribute, ast.Subscript, ast.Slice, ast.Constant,
+    ast.Tuple, ast.List, ast.Set, ast.Load,
+) + tuple(
+    # subscripts are wrapped in these up to Python 3.8
+    getattr(ast, name) for name in ('Index', 'ExtSlice') if hasattr(ast, name)
+)
+
+# what a pure guard may depend on
+PURE_ATTRS = {('state', 'name'), ('event', 'name'), ('event', 'input')}
+
+# an attribute path of the instance, the older condition spelling
+_PATH = re.compile(r'!?[A-Za-z_]\w*(\.[A-Za-z_]\w*)*\Z')
+
+
+def is_expression(condition):
+    '''Whether string `condition` is a guard expression.
+
+    Plain dotted paths like ``'is_manager'`` or ``'!account.open'`` are
+    looked up on the instance instead, unless they start with one of
+    :data:`GUARD_ARGS`. A leading ``!`` negates expressions as well, see
+    :meth:`.Machine.add_transition`.
+    '''
+    if not _PATH.match(condition):
+        return True
+    return condition.lstrip('!').split('.', 1)[0] in GUARD_ARGS
+
+
+def compile_guard(expression):
+    '''Compile a guard expression to a ``guard(state, event, instance)``
+    function.
+
+    The guard is :func:`pure` if it only reads the attributes in
+    :data:`PURE_ATTRS`.
+
+    :raises: :class:`~yasm.error.InvalidCondition` if the expression is
+        not valid or uses anything not allowed
+    '''
+    try:
+        tree = ast.parse(expression.strip(), '<guard>', 'eval')
+    except SyntaxError as ex:
+        raise InvalidCondition(f'invalid guard {expression!r}: {ex.msg}')
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise InvalidCondition(
+                f'{type(node).__name__} not allowed in guard {expression!r}'
+            )
+        if isinstance(node, ast.Name) and node.id not in GUARD_ARGS:
+            raise InvalidCondition(
+                f'unknown name {node.id!r} in guard {expression!r}'
+            )
+        if isinstance(node, ast.Attribute) and node.attr.startswith('_'):
+            raise InvalidCondition(
+                f'private attribute {node.attr!r} in guard {expression!r}'
+            )
+    arguments = ast.arguments(
+        posonlyargs=[], args=[ast.arg(arg=name) for name in GUARD_ARGS],
+        kwonlyargs=[], kw_defaults=[], defaults=[],
+    )
+    function = ast.Expression(body=ast.Lambda(args=arguments, body=tree.body))
+    ast.fix_missing_locations(function)
+    guard = eval(compile(function, '<guard>', 'eval'), {'__builtins__': {}})
+    guard.expression = expression
+    guard.pure = _reads_pure_attrs(tree)
+    return guard
+
+
+def _reads_pure_attrs(tree):
+    names = attrs = 0
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            names += 1
+        elif isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name):
+            if (node.value.id, node.attr) not in PURE_ATTRS:
+                return False
+            attrs += 1
+    # every name is read through one of the pure attributes
+    return names == attrs
+
+
+def pure(guard):
+    '''Mark `guard` as only depending on ``state.name``, ``event.name`` and
+    ``event.input``, so the transition it selects can be cached.
+
+    Can be used as a decorator. See :meth:`.Machine.add_transition` to mark
+    all conditions of a transition at once.
+    '''
+    guard.pure = True
+    return guard
+
+
+class GuardCache(object):
+    '''Bounded LRU of the transitions selected by pure guards.
+
+    Keys are ``(state name, event name, event input)``. The cache is
+    cleared whenever the machine's transitions change, `hits` and `misses`
+    count lookups since the cache was created.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entries = self._entries
+        try:
+            value = entries[key]
+            entries.move_to_end(key)
+        except (KeyError, TypeError):
+            # unknown, evicted meanwhile by another thread, or unhashable
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        entries = self._entries
+        try:
+            entries[key] = value
+        except TypeError:
+            return
+        if len(entries) > self.size:
+            try:
+                entries.popitem(last=False)
+            except KeyError:
+                pass
+
+    def clear(self):
+        self._entries.clear()
+
+    def __repr__(self):
+        return (
+            f'<GuardCache {len(self)}/{self.size}, hits={self.hits}, '
+            f'misses={self.misses}>'
+        )
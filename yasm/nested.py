@@ -1,11 +1,22 @@
+from types import MappingProxyType
+
 from six import string_types
 
-from .core import State, Machine
+from .core import Handlers, State, Machine, Event, _index_records
 from .error import InvalidTransition
 
 
+# shared by every state without handlers in its hierarchy, never mutated
+_NO_HANDLERS = MappingProxyType({})
+
+
 class NestedState(State):
 
+    __slots__ = (
+        'parent', 'children', 'initial', 'depth', 'ancestors',
+        'handler_chains', '_handlers', '_chains_version',
+    )
+
     separator = '.'
 
     def __init__(self, name, on_enter=None, on_exit=None, parent=None,
@@ -15,14 +26,77 @@ class NestedState(State):
         if parent:
             parent.children[self.name] = self
             self.name = parent.name + self.separator + self.name
+            # outermost first
+            self.ancestors = parent.ancestors + (parent,)
+        else:
+            self.ancestors = ()
+        self.depth = len(self.ancestors)
         self.children = {}
         self.initial = initial
+        self.handler_chains = None
+        self._chains_version = None
+
+    @property
+    def handlers(self):
+        return self._handlers
+
+    @handlers.setter
+    def handlers(self, handlers):
+        if not isinstance(handlers, Handlers):
+            handlers = Handlers(handlers)
+        self._handlers = handlers
+        Handlers.version += 1
+
+    def _build_handler_chains(self):
+        '''Flatten the handlers of this state and its ancestors.
+
+        Gives ``{event name: ((state, handler), ...)}`` innermost first. The
+        chains are rebuilt on the next event once the handlers of any
+        state change, see :class:`~yasm.core.Handlers`.
+        '''
+        self._chains_version = Handlers.version
+        chains = {}
+        state = self
+        while state:
+            for name, handler in state.handlers.items():
+                chains.setdefault(name, []).append((state, handler))
+            state = state.parent
+        if chains:
+            self.handler_chains = {
+                name: tuple(chain) for name, chain in chains.items()
+            }
+        else:
+            self.handler_chains = _NO_HANDLERS
+        return self.handler_chains
 
     def _on(self, event, instance):
-        if event.name in self.handlers:
-            self.handlers[event.name](self, event, instance)
-        if self.parent and event.propagate:
-            self.parent._on(event, instance)
+        chains = self.handler_chains
+        if self._chains_version != Handlers.version:
+            chains = self._build_handler_chains()
+        chain = chains.get(event.name)
+        if chain:
+            for state, handler in chain:
+                if state is not self and not event.propagate:
+                    break
+                handler(state, event, instance)
+
+    def _handler_chain(self, event):
+        chains = self.handler_chains
+        if self._chains_version != Handlers.version:
+            chains = self._build_handler_chains()
+        return chains.get(event.name, ())
+
+    def _copy(self, parent=None):
+        '''Copy the state and its descendants, linked to `parent`.'''
+        state = super(NestedState, self)._copy()
+        state.parent = parent
+        state.ancestors = parent.ancestors + (parent,) if parent else ()
+        state.children = {
+            name: child._copy(state) for name, child in self.children.items()
+        }
+        state.handler_chains = None
+        state._chains_version = None
+        return state
 
     def __repr__(self):
         return f'<NestedState {self.name}, handlers={self.handlers.keys()}>'
@@ -31,71 +105,217 @@ class NestedState(State):
 class NestedMachine(Machine):
 
     StateClass = NestedState
+    # number of previous leaf states remembered per instance, see
+    # :meth:`set_previous_leaf_state`
     STACK_SIZE = 32
+    # number of (from, to) exit/enter paths remembered, see _get_paths
+    PATH_CACHE_SIZE = 1024
 
-    def _get_transition(self, state, event, instance):
-        target = state
-        while 1:
-            transitions = self.transitions[(target.name, event.name)]
-            if transitions:
-                break
-            if not target.parent:
-                raise InvalidTransition(f'{state} cannot handle event {event}')
-            target = target.parent
-        for transition in transitions:
-            for cond, target in transition['conditions']:
-                if isinstance(cond, list):
-                    predicate = instance
-                    for pre in cond:
-                        predicate = getattr(predicate, pre)
-                else:
-                    predicate = cond
-                if callable(predicate):
-                    predicate = predicate(state, event, instance)
-                if predicate != target:
-                    break
-            else:
-                return transition
-        return None
+    def __init__(self, name, *args, **kwargs):
+        super(NestedMachine, self).__init__(name, *args, **kwargs)
+        self._paths = {}
+        # ((root state, initial leaf), ...) see :meth:`add_region`
+        self.regions = ()
+        # {region index or state name: compiled wildcards}, see
+        # _wildcards_of
+        self._region_wildcards = {}
 
-    def _get_top_state(self, state, other_state):
-        ancestors = []
-        other_ancestors = []
-        while state.parent:
-            ancestors.append(state.parent)
-            state = state.parent
-        while other_state.parent:
-            other_ancestors.append(other_state.parent)
-            other_state = other_state.parent
+    def _reset(self):
+        super(NestedMachine, self)._reset()
+        self._paths = {}
+        self.regions = ()
+        self._region_wildcards = {}
 
+    def compile(self):
+        for state in self.state_list:
+            state._build_handler_chains()
+        self._region_wildcards = {}
+        return super(NestedMachine, self).compile()
+
+    def _wildcards_of(self, state):
+        '''Wildcard transitions only apply to the states of the region they
+        lead to, or of the main state.
+        '''
+        wildcards = self._compiled_wildcards
+        if not self.regions or not wildcards:
+            return wildcards
+        cache = self._region_wildcards
+        scoped = cache.get(state.name)
+        if scoped is None:
+            region = self._region_of(state.name)
+            scoped = cache.get(region)
+            if scoped is None:
+                scoped = cache[region] = {}
+                for event, records in wildcards.items():
+                    records = tuple(
+                        record for record in records
+                        if self._region_of(record[1].name) == region
+                    )
+                    if records:
+                        scoped[event] = _index_records(records)
+            cache[state.name] = scoped
+        return scoped
+
+    def _fallback_records(self, state, event):
+        if event.name == '__switch__' and self.regions and \
+                event.input in self.states and \
+                self._region_of(event.input) != self._region_of(state.name):
+            # switching across regions is not a transition either
+            return ()
+        return super(NestedMachine, self)._fallback_records(state, event)
+
+    def _compile_order(self):
+        # parents first, their records are inherited by their children
+        return sorted(self.state_list, key=lambda state: state.depth)
+
+    def _compile_state(self, state, compiled):
+        '''Merge the records `state` inherits from its ancestors.
+
+        A state without transitions of its own shares the mapping of its
+        parent, otherwise its own records override the inherited ones per
+        event, so finding the transitions of any state is a single lookup.
+
+        Wildcard transitions take precedence over inherited ones, as when
+        ancestors were looked up one after the other, so events with
+        wildcards are not inherited.
+        '''
+        records = super(NestedMachine, self)._compile_state(state, compiled)
+        parent = state.parent
+        if parent is None or self.states.get(parent.name) is not parent:
+            return records
+        inherited = compiled[self.state_codes[parent.name]][1]
+        wildcards = self._wildcards_of(state)
+        if wildcards and not wildcards.keys().isdisjoint(inherited):
+            inherited = {
+                event: inherited_records
+                for event, inherited_records in inherited.items()
+                if event not in wildcards
+            }
+        if not records:
+            return inherited
+        if not inherited:
+            return records
+        merged = dict(inherited)
+        merged.update(records)
+        return merged
+
+    def _affected_states(self, state):
+        stack = [state]
+        while stack:
+            state = stack.pop()
+            yield state
+            stack.extend(state.children.values())
+
+    def _missing_transitions(self, state, event):
+        # ancestors' transitions are already merged in, see _compile_state
+        if self.regions:
+            # the event may well be meant for another region, whether any
+            # state handles it is checked by _dispatch_regions
+            return ()
+        raise InvalidTransition(f'{state} cannot handle event {event}')
+
+    def _validate_transition(self, from_state, to_state, event):
+        super(NestedMachine, self)._validate_transition(
+            from_state, to_state, event
+        )
+        if from_state != '*' and \
+                self._region_of(from_state) != self._region_of(to_state):
+            raise InvalidTransition(
+                f'{from_state} and {to_state} are in different regions'
+            )
+
+    def _get_top_state(self, state, other_state):
+        '''Return the innermost common ancestor of two states, if any.'''
         top = None
-        for ancestor, other_ancestor in zip(reversed(ancestors),
-                                            reversed(other_ancestors)):
-            if ancestor is other_ancestor:
-                top = ancestor
-            else:
+        for ancestor, other_ancestor in zip(state.ancestors,
+                                            other_state.ancestors):
+            if ancestor is not other_ancestor:
                 break
+            top = ancestor
         return top
 
+    def _get_paths(self, from_state, to_state):
+        '''Return the states exited and entered going `from_state` ->
+        `to_state`, innermost first and outermost first respectively.
+
+        Paths are remembered in a bounded cache, so after warm-up a
+        transition costs the same whatever the depth of the hierarchy.
+        '''
+        key = (from_state, to_state)
+        paths = self._paths.get(key)
+        if paths is None:
+            top = self._get_top_state(from_state, to_state)
+            start = top.depth + 1 if top else 0
+            paths = (
+                (from_state,) + from_state.ancestors[start:][::-1],
+                to_state.ancestors[start:] + (to_state,),
+            )
+            cache = self._paths
+            if len(cache) >= self.PATH_CACHE_SIZE:
+                try:
+                    cache.pop(next(iter(cache)), None)
+                except (RuntimeError, StopIteration):
+                    # emptied or resized by another dispatching thread
+                    pass
+            cache[key] = paths
+        return paths
+
+    def _own_state(self, state):
+        # states link to their parent and children, the whole tree is copied
+        root = state.ancestors[0] if state.ancestors else state
+        states = [root._copy()]
+        for state in states:
+            states.extend(state.children.values())
+        self._replace_states(states)
+        # cached paths hold the replaced states
+        self._paths = {}
+
+    def _exit_path(self, state, to_state):
+        return self._get_paths(state, to_state)[0]
+
+    def _enter_path(self, state, from_state):
+        return self._get_paths(from_state, state)[1]
+
+    def _init_instance(self, instance):
+        instance._yasm_history = _History(self.STACK_SIZE)
+        super(NestedMachine, self)._init_instance(instance)
+        if self.timeouts:
+            # the initial state is in its ancestors as well
+            for ancestor in self._get_state(self.initial).ancestors:
+                self._arm_timeout(ancestor, instance)
+        if self.regions:
+            self._region_codes(instance)
+
     def _enter_state(self, state, event, instance, from_state):
-        instance.state = state.name
-        top_state = event.cargo.get('top_state') or \
-            self._get_top_state(state, from_state)
-        path = [state]
-        while state.parent and state.parent != top_state:
-            path.append(state.parent)
-            state = state.parent
-        for state in reversed(path):
-            state.on_enter(state, event, instance, from_state)
+        self._entering(state, instance, from_state)
+        for entered in self._get_paths(from_state, state)[1]:
+            entered.on_enter(entered, event, instance, from_state)
+        self._entered(state, instance)
 
     def _exit_state(self, state, event, instance, to_state):
-        state.on_exit(state, event, instance, to_state)
-        top_state = self._get_top_state(state, to_state)
-        while state.parent and state.parent != top_state:
-            state = state.parent
-            state.on_exit(state, event, instance, to_state)
-        instance.state = None
-        event.cargo['top_state'] = top_state
+        self._exiting(state, instance, to_state)
+        for exited in self._get_paths(state, to_state)[0]:
+            exited.on_exit(exited, event, instance, to_state)
+        instance._state_code = None
+
+    def _keeps_records(self):
+        # the leaf state history
+        return True
+
+    def _exiting(self, state, instance, to_state):
+        instance._yasm_history.push(instance._state_code)
+        super(NestedMachine, self)._exiting(state, instance, to_state)
+
+    def _entering(self, state, instance, from_state):
+        # the state is current already while its ancestors are entered
+        instance._state_code = self.state_codes[state.name]
+        super(NestedMachine, self)._entering(state, instance, from_state)
+
+    def _entered(self, state, instance):
+        if self.store is not None and \
+                instance._yasm_history is not _NO_HISTORY:
+            # only the main state is saved, not those of regions
+            self._save_state(instance, state)
 
     def traverse(self, states, parent=None, remap={}):
         new_states = []
@@ -145,34 +365,201 @@ class NestedMachine(Machine):
         states = self.traverse(states)
         super(NestedMachine, self).add_states(states, initial, force)
 
-    # def set_previous_leaf_state(self, event=None):
-    #     '''Transition to a previous leaf state. This makes a dynamic transition  # noqa
-    #     to a historical state. The current `leaf_state` is saved on the stack
-    #     of historical leaf states when calling this method.
-
-    #     :param event: (Optional) event that is passed to states involved in the  # noqa
-    #         transition
-    #     :type event: :class:`.Event`
-
-    #     '''
-    #     if event is not None:
-    #         event.state_machine = self
-    #     from_state = self.leaf_state
-    #     try:
-    #         to_state = self.state_stack[-1]
-    #     except IndexError:
-    #         return
-    #     top_state = self._exit_states(event, from_state, to_state)
-    #     self._enter_states(event, top_state, to_state)
-
-    # def revert_to_previous_leaf_state(self, event=None):
-    #     '''Similar to :func:`set_previous_leaf_state`
-    #     but the current leaf_state is not saved on the stack of states. It
-    #     allows to perform transitions further in the history of states.
-
-    #     '''
-    #     self.set_previous_leaf_state(event)
-    #     try:
-    #         self.state_stack.pop()
-    #     except IndexError:
-    #         return
+    def add_region(self, name, states, initial):
+        '''Add an orthogonal region, a hierarchy of states an instance is
+        in at the same time as in its main state and other regions.
+
+        The region is a top-level state `name` with `states` as children,
+        `initial` being the name of one of them. :func:`~yasm.dispatch`
+        routes every event to the main state first, then to every region
+        in the order they were added, all through the same compiled table.
+        While a region handles an event, ``instance.state`` is its leaf
+        state. Transitions cannot cross regions and regions keep no
+        history. Dispatching to the instance from a callback needs
+        `run_to_completion`, :meth:`scan` and :func:`~yasm.aio.adispatch`
+        only drive the main state.
+
+        Add regions before creating instances, see :meth:`active_states`.
+        '''
+        self.add_states([{'name': name, 'children': states}])
+        leaf = self._get_state(name + NestedState.separator + initial)
+        self.regions += ((name, leaf.name),)
+
+    def active_states(self, instance):
+        '''Names of the main leaf state and of each region's leaf state.'''
+        state_list = self.state_list
+        return (instance.state,) + tuple(
+            state_list[code].name for code in self._region_codes(instance)
+        )
+
+    def _region_of(self, state_name):
+        '''Index of the region of `state_name`, None for the main state.'''
+        state = self._get_state(state_name)
+        root = state.ancestors[0].name if state.ancestors else state.name
+        for index, (name, _) in enumerate(self.regions):
+            if name == root:
+                return index
+        return None
+
+    def _region_codes(self, instance):
+        '''Leaf state codes of the regions of `instance`, entered on first
+        use.
+        '''
+        codes = instance.__dict__.get('_region_codes')
+        if codes is None:
+            codes = instance._region_codes = []
+        if len(codes) < len(self.regions):
+            main = instance._state_code
+            event = Event('initialize')
+            try:
+                for _, initial in self.regions[len(codes):]:
+                    state = self._get_state(initial)
+                    instance._state_code = self.state_codes[initial]
+                    if self.timeouts:
+                        for entered in state.ancestors + (state,):
+                            self._arm_timeout(entered, instance)
+                    state.on_enter(state, event, instance, None)
+                    codes.append(instance._state_code)
+            finally:
+                instance._state_code = main
+        return codes
+
+    def _dispatch_regions(self, compiled, instance, event, handled):
+        '''Let every region of `instance` handle `event`.
+
+        `handled` tells whether the main state has transitions for `event`.
+        With `raise_invalid_transition` set, raises
+        :class:`~yasm.error.InvalidTransition` if neither the main state
+        nor any region has.
+        '''
+        codes = self._region_codes(instance)
+        attrs = instance.__dict__
+        main, history = instance._state_code, attrs.get('_yasm_history')
+        attrs['_yasm_history'] = _NO_HISTORY
+        try:
+            for index, code in enumerate(codes):
+                instance._state_code = code
+                state, records = compiled[code]
+                state._on(event, instance)
+                records = records.get(event.name) or \
+                    self._fallback_records(state, event)
+                if not records:
+                    continue
+                handled = True
+                record = self._select(records, state, event, instance)
+                if record is not None:
+                    self._apply(record, state, event, instance)
+                    codes[index] = instance._state_code
+        finally:
+            instance._state_code = main
+            attrs['_yasm_history'] = history
+        if not handled and event.raise_invalid_transition:
+            raise InvalidTransition(
+                f'no state of {instance} can handle event {event}'
+            )
+
+    def switch_to(self, instance, state_name, event=None):
+        region = self._region_of(state_name) if self.regions else None
+        if region is None:
+            return super(NestedMachine, self).switch_to(
+                instance, state_name, event
+            )
+        codes = self._region_codes(instance)
+        attrs = instance.__dict__
+        main, history = instance._state_code, attrs.get('_yasm_history')
+        attrs['_yasm_history'] = _NO_HISTORY
+        instance._state_code = codes[region]
+        try:
+            super(NestedMachine, self).switch_to(instance, state_name, event)
+            codes[region] = instance._state_code
+        finally:
+            instance._state_code = main
+            attrs['_yasm_history'] = history
+
+    def get_history(self, instance):
+        '''Names of the previous leaf states of `instance`, latest first.'''
+        history = instance._yasm_history
+        return tuple(
+            self.state_list[history.peek(depth)].name
+            for depth in range(len(history))
+        )
+
+    def set_previous_leaf_state(self, instance, event=None):
+        '''Transition to the previous leaf state. This makes a dynamic
+        transition to a historical state. The current leaf state is saved
+        on the history of leaf states, like with any transition.
+
+        Nothing happens if there is no history.
+
+        :param event: (Optional) event that is passed to states involved in
+            the transition
+        :type event: :class:`.Event`
+
+        '''
+        history = instance._yasm_history
+        if not history:
+            return
+        self._go_back(instance, history.peek(), event)
+
+    def revert_to_previous_leaf_state(self, instance, event=None):
+        '''Similar to :meth:`set_previous_leaf_state` but the current leaf
+        state is not saved on the history, so calling it again goes further
+        back in the history of states.
+
+        '''
+        history = instance._yasm_history
+        if not history:
+            return
+        self._go_back(instance, history.pop(), event)
+        # forget the state just left
+        history.pop()
+
+    def _go_back(self, instance, code, event):
+        state = self.state_list[instance._state_code]
+        to_state = self.state_list[code]
+        if event is None:
+            event = Event('__history__', input=to_state.name)
+        self._exit_state(state, event, instance, to_state)
+        self._enter_state(to_state, event, instance, state)
+
+
+class _History(object):
+    '''Bounded stack of the codes of an instance's previous leaf states.
+
+    A ring buffer allocated once, when full pushing drops the oldest entry.
+    '''
+
+    __slots__ = ('codes', 'top', 'count')
+
+    def __init__(self, size):
+        self.codes = [None] * size
+        self.top = -1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, code):
+        codes = self.codes
+        if not codes:
+            return
+        self.top = top = (self.top + 1) % len(codes)
+        codes[top] = code
+        if self.count < len(codes):
+            self.count += 1
+
+    def peek(self, depth=0):
+        if depth >= self.count:
+            raise IndexError('history is too short')
+        return self.codes[(self.top - depth) % len(self.codes)]
+
+    def pop(self):
+        code = self.peek()
+        self.codes[self.top] = None
+        self.top = (self.top - 1) % len(self.codes)
+        self.count -= 1
+        return code
+
+
+# history of instances handling an event in a region, records nothing
+_NO_HISTORY = _History(0)
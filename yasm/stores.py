@@ -0,0 +1,181 @@
+'''Persistent instance states.
+
+A machine with a :attr:`~yasm.Machine.store` saves the state of an instance
+every time it enters one, and :meth:`.Machine.hydrate` restores the states
+of many instances at once. Instances are identified by a key, their `id`
+attribute by default.
+
+An instance without a stored state is in the initial state: creating an
+instance saves nothing and :meth:`.Machine.reinit_instance` deletes the
+stored state.
+'''
+import sqlite3
+from abc import ABC, abstractmethod
+from operator import attrgetter
+from threading import RLock
+from time import monotonic
+
+
+class StateStore(ABC):
+    '''Base class of state stores.
+
+    :param key: name of the attribute identifying an instance
+    '''
+
+    def __init__(self, key='id'):
+        self.key = attrgetter(key)
+
+    @abstractmethod
+    def save(self, key, state_name):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        '''Forget the state of `key`, if any.'''
+
+    @abstractmethod
+    def load_many(self, keys):
+        '''Return the ``{key: state name}`` of the `keys` that are stored.'''
+
+    def load(self, key):
+        return self.load_many([key]).get(key)
+
+    def flush(self):
+        '''Write pending changes, if the store buffers them.'''
+
+    def tick(self):
+        '''Write pending changes that are due, see :meth:`.Machine.tick`.'''
+
+    def close(self):
+        self.flush()
+
+
+class MemoryStore(StateStore):
+    '''Keeps states in a dict, e.g. to share them between instances.'''
+
+    def __init__(self, key='id'):
+        super(MemoryStore, self).__init__(key)
+        self.states = {}
+
+    def save(self, key, state_name):
+        self.states[key] = state_name
+
+    def delete(self, key):
+        self.states.pop(key, None)
+
+    def load_many(self, keys):
+        states = self.states
+        return {key: states[key] for key in keys if key in states}
+
+
+class SQLiteStore(StateStore):
+    '''Keeps states in a SQLite table, writing them in batches.
+
+    Saved states are buffered and written in a single transaction once
+    `batch_size` of them are pending or `flush_interval` seconds after the
+    previous write, whichever comes first. The interval is checked when
+    saving and by :meth:`tick`, run periodically by :meth:`.Machine.tick`
+    or :func:`yasm.aio.run_store`, so that quiet periods do not leave states
+    pending. Call :meth:`flush` when done. Only the latest state of an
+    instance is written, deletions are buffered the same way.
+
+    The store can be shared by threads, it serialises its use of the
+    connection. A connection passed in must then be opened with
+    ``check_same_thread=False``.
+
+    :param database: path of the database or an open
+        :class:`sqlite3.Connection`
+    :param table: name of the table, created if needed
+    '''
+
+    def __init__(self, database, table='yasm_states', key='id',
+                 batch_size=100, flush_interval=0.05, clock=monotonic):
+        super(SQLiteStore, self).__init__(key)
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(
+                database, check_same_thread=False
+            )
+        if not table.isidentifier():
+            raise ValueError(f'invalid table name: {table!r}')
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        # {key: state name, or None if deleted} not written yet
+        self.pending = {}
+        self._saved = 0
+        self._flushed_at = clock()
+        # flush saves while holding it
+        self._lock = RLock()
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} '
+                '(key PRIMARY KEY, state TEXT NOT NULL)'
+            )
+
+    def save(self, key, state_name):
+        with self._lock:
+            self.pending[key] = state_name
+            self._saved += 1
+            if self._saved >= self.batch_size or self._due():
+                self.flush()
+
+    def delete(self, key):
+        self.save(key, None)
+
+    def _due(self):
+        return self.clock() - self._flushed_at >= self.flush_interval
+
+    def tick(self):
+        with self._lock:
+            if self.pending and self._due():
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._saved = 0
+            self._flushed_at = self.clock()
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            saved = [item for item in pending.items() if item[1] is not None]
+            deleted = [(key,) for key, name in pending.items() if name is None]
+            with self.connection:
+                self.connection.executemany(
+                    f'INSERT OR REPLACE INTO {self.table} (key, state) '
+                    'VALUES (?, ?)',
+                    saved,
+                )
+                self.connection.executemany(
+                    f'DELETE FROM {self.table} WHERE key = ?', deleted
+                )
+
+    def load_many(self, keys):
+        keys = list(keys)
+        states = {}
+        with self._lock:
+            # stay well below SQLite's limit of query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                marks = ', '.join('?' * len(chunk))
+                states.update(self.connection.execute(
+                    f'SELECT key, state FROM {self.table} '
+                    f'WHERE key IN ({marks})',
+                    chunk,
+                ))
+            pending = self.pending
+            for key in keys:
+                if key not in pending:
+                    continue
+                if pending[key] is None:
+                    states.pop(key, None)
+                else:
+                    states[key] = pending[key]
+        return states
+
+    def close(self):
+        with self._lock:
+            super(SQLiteStore, self).close()
+            self.connection.close()
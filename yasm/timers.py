@@ -0,0 +1,119 @@
+'''State timeouts.
+
+A state added with a `timeout` arms a timer whenever an instance enters it
+and cancels it when the instance leaves, see :meth:`.Machine.add_state`.
+Timers of a machine, and of its clones, live in one :class:`TimerWheel`
+which fires expired timeouts when ticked, so idle instances cost a dict
+entry each rather than a thread or a task.
+'''
+from math import ceil
+from threading import Lock
+from time import monotonic
+
+
+class TimerWheel(object):
+    '''Hashed timing wheel of state timeouts.
+
+    Time is split in ticks of `resolution` seconds, a timer is put in the
+    slot of the tick its deadline falls in, modulo the number of slots.
+    Arming and cancelling are a dict insert and delete, :meth:`tick` only
+    looks at the slots of the ticks elapsed since it was last called.
+    A wheel can be armed and ticked from several threads, timeouts are
+    fired outside its lock.
+
+    :param resolution: length of a tick in seconds, timeouts fire at most
+        this late
+    :param size: number of slots, timers more than `size` ticks away stay
+        in their slot for more than a round
+    :param clock: function returning the current time in seconds
+    '''
+
+    def __init__(self, resolution=0.1, size=512, clock=monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        # {(id(instance), state name): (deadline, instance, state, event)}
+        self._slots = [{} for _ in range(size)]
+        # the slot of every armed timer
+        self._armed = {}
+        # the last tick processed
+        self._tick = int(clock() / resolution)
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._armed)
+
+    def arm(self, instance, state_name, timeout, event_name):
+        '''Dispatch `event_name` to `instance` in `timeout` seconds, unless
+        it is cancelled first. An armed timer of the same state is reset.
+        '''
+        key = (id(instance), state_name)
+        deadline = self.clock() + timeout
+        with self._lock:
+            slot = self._armed.pop(key, None)
+            if slot is not None:
+                del slot[key]
+            tick = max(ceil(deadline / self.resolution), self._tick + 1)
+            slot = self._slots[tick % len(self._slots)]
+            slot[key] = (deadline, instance, state_name, event_name)
+            self._armed[key] = slot
+
+    def cancel(self, instance, state_name):
+        key = (id(instance), state_name)
+        with self._lock:
+            slot = self._armed.pop(key, None)
+            if slot is not None:
+                del slot[key]
+
+    def tick(self, now=None):
+        '''Fire the timeouts expired at `now`, the current time by default.
+
+        Expired instances are grouped by machine, state and timeout event
+        and dispatched with :func:`~yasm.dispatch_many`, the event `input`
+        is the name of the state that timed out. A batch raising does not
+        stop the others from firing, the first exception is re-raised once
+        all were dispatched.
+
+        :returns: number of timeouts fired
+        '''
+        if now is None:
+            now = self.clock()
+        target = int(now / self.resolution)
+        batches = {}
+        with self._lock:
+            slots, armed = self._slots, self._armed
+            if target - self._tick >= len(slots):
+                ticks = range(len(slots))
+            else:
+                ticks = range(self._tick + 1, target + 1)
+            self._tick = max(self._tick, target)
+            for tick in ticks:
+                slot = slots[tick % len(slots)]
+                expired = [
+                    key for key, timer in slot.items() if timer[0] <= now
+                ]
+                for key in expired:
+                    _, instance, state_name, event_name = slot.pop(key)
+                    del armed[key]
+                    batch = (instance.machine, state_name, event_name)
+                    batches.setdefault(batch, []).append(instance)
+
+        fired = 0
+        error = None
+        for (machine, state_name, event_name), instances in batches.items():
+            event = machine.EventClass(event_name, state_name)
+            try:
+                _fire(machine, instances, event)
+            except Exception as ex:
+                error = error or ex
+                continue
+            fired += len(instances)
+        if error is not None:
+            raise error
+        return fired
+
+
+def _fire(machine, instances, event):
+    # imported here, utils depends on core which depends on this module
+    from .utils import dispatch_many
+
+    dispatch_many(instances, event)
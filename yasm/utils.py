@@ -1,4 +1,9 @@
-from six import string_types
+from collections import deque
+from threading import Lock
+
+from .core import Event
+from .core import get_event_handlers  # noqa: F401
+from .error import NoState
 
 
 def on_event(name):
@@ -8,17 +13,6 @@ def on_event(name):
     return wrapper
 
 
-def get_event_handlers(obj):
-    handlers = {}
-    for attr in dir(obj):
-        if attr.startswith('__'):
-            continue
-        value = getattr(obj, attr)
-        if getattr(value, 'on_event', ''):
-            handlers[value.on_event] = value
-    return handlers
-
-
 # add_state/add_states can used as decorator
 def add_state(obj, name, state=None, force=False, clone_machine=False):
     def wrapper(obj):
@@ -42,33 +36,325 @@ def add_states(states, initial=None, force=False, clone_machine=False):
     return wrapper
 
 
-def dispatch(instance, event):
+def dispatch(instance, event, input=None):
     '''Dispatch an event to a state machine.
 
     If using nested state machines (HSM), it has to be called on a root
     state machine in the hierarchy.
 
+    `event` may also be given as an event name plus `input`, in which case
+    a pooled event object is used for the call, so callbacks must not keep
+    references to it.
+
+    :param event: Event to be dispatched, or an event name
+    :type event: :class:`.Event` or |Hashable|
+
+    :param input: input of the event when dispatching by name
+
+    With :attr:`.Machine.concurrent` set, an event for an instance that is
+    busy dispatching in another thread is queued and this call returns at
+    once, the busy thread runs it after the current one, see
+    :func:`_dispatch_queued`.
+
+    With :attr:`.Machine.run_to_completion` set, events dispatched from
+    callbacks of a running transition are queued and run after it, see
+    :func:`_dispatch_deferred`.
+
+    '''
+    machine = instance.machine
+    if not isinstance(event, Event):
+        return _dispatch_name(machine, instance, event, input)
+    if machine.concurrent:
+        return _dispatch_queued(machine, instance, event)
+    if machine.run_to_completion:
+        return _dispatch_deferred(machine, instance, event)
+    _dispatch(machine, instance, event)
+
+
+def _dispatch(machine, instance, event):
+    compiled = machine._compiled
+    if compiled is None:
+        compiled = machine.compile()._compiled
+    try:
+        state, records = compiled[instance._state_code]
+    except TypeError:
+        raise NoState(f'{instance} is not in any state')
+    state._on(event, instance)
+    records = records.get(event.name) or \
+        machine._fallback_records(state, event)
+    if records and not records[0][0]:
+        # the first transition has no conditions, nothing to select
+        record = records[0]
+    else:
+        record = machine._select(records, state, event, instance)
+    if record is not None:
+        _, to_state, before, after, _ = record
+
+        if before:
+            if before.__class__ is str:
+                before = getattr(instance, before)
+            before(state, event, instance)
+        machine._exit_state(state, event, instance, to_state)
+        machine._enter_state(to_state, event, instance, state)
+        if after:
+            if after.__class__ is str:
+                after = getattr(instance, after)
+            after(to_state, event, instance)
+    if machine.regions:
+        machine._dispatch_regions(compiled, instance, event, bool(records))
+
+
+def _dispatch_name(machine, instance, name, input):
+    if machine.concurrent:
+        # a queued event may outlive this call, it cannot be pooled
+        return _dispatch_queued(
+            machine, instance, machine.EventClass(name, input)
+        )
+    if machine.run_to_completion:
+        return _dispatch_deferred(
+            machine, instance, machine.EventClass(name, input)
+        )
+    pool = machine._event_pool
+    try:
+        event = pool.pop()
+        event._reuse(name, input)
+    except IndexError:
+        event = machine.EventClass(name, input)
+    try:
+        dispatch(instance, event)
+    finally:
+        event.input = event._cargo = None
+        pool.append(event)
+
+
+class _Mailbox(deque):
+    '''Events waiting for an instance that is busy dispatching.'''
+
+    __slots__ = ('lock',)
+
+    def __init__(self):
+        super(_Mailbox, self).__init__()
+        self.lock = Lock()
+
+
+def _dispatch_queued(machine, instance, event):
+    '''Run-to-completion dispatch, safe to call from many threads.
+
+    The event is appended to the instance's mailbox. Whichever thread holds
+    the mailbox lock runs queued events one by one, so transitions of one
+    instance never interleave while different instances are dispatched in
+    parallel. Exceptions raised by callbacks surface in the thread that
+    ran the event.
+    '''
+    attrs = instance.__dict__
+    mailbox = attrs.get('_yasm_mailbox')
+    if mailbox is None:
+        # setdefault is atomic, racing threads end up with the same mailbox
+        mailbox = attrs.setdefault('_yasm_mailbox', _Mailbox())
+    mailbox.append(event)
+    lock = mailbox.lock
+    # re-check after releasing, an event may have been queued meanwhile
+    while mailbox and lock.acquire(False):
+        try:
+            while mailbox:
+                _dispatch(machine, instance, mailbox.popleft())
+        finally:
+            lock.release()
+
+
+def _dispatch_deferred(machine, instance, event):
+    '''Run-to-completion dispatch for a single thread.
+
+    While an instance is dispatching, further events for it are appended to
+    its queue and run one after another once the current transition has
+    finished, so cascades of internal events run in constant stack depth.
+    If a callback raises, the events still queued are dropped.
+    '''
+    attrs = instance.__dict__
+    queue = attrs.get('_yasm_queue')
+    if queue is not None:
+        queue.append(event)
+        return
+    queue = attrs['_yasm_queue'] = deque()
+    try:
+        _dispatch(machine, instance, event)
+        while queue:
+            _dispatch(machine, instance, queue.popleft())
+    finally:
+        del attrs['_yasm_queue']
+
+
+def switch_to(instance, state_name, event=None):
+    '''Force an instance into another state, see :meth:`.Machine.switch_to`.
+
+    :param state_name: Name of the target state
+    :type state_name: |string|
+
+    '''
+    instance.machine.switch_to(instance, state_name, event)
+
+
+def dispatch_many(instances, event):
+    '''Dispatch one event to many instances sharing a state machine.
+
+    Instances are grouped by their current state, so transitions for `event`
+    are looked up once per state instead of once per instance. If the first
+    transition of a state has no conditions, it is taken by the whole group
+    without evaluating anything per instance.
+
+    With :attr:`.Machine.concurrent` or :attr:`.Machine.run_to_completion`
+    set, every instance goes through :func:`dispatch` instead, so the
+    event is queued like any other.
+
+    :param instances: instances of one :func:`~yasm.state_machine` class
+    :type instances: |Iterable|
+
     :param event: Event to be dispatched
     :type event: :class:`.Event`
 
     '''
+    groups = {}
+    for instance in instances:
+        code = instance._state_code
+        group = groups.get(code)
+        if group is None:
+            groups[code] = [instance]
+        else:
+            group.append(instance)
+    if not groups:
+        return
+
     machine = instance.machine
-    state = machine.get_state(instance.state)
-    state._on(event, instance)
-    transition = machine._get_transition(state, event, instance)
-    if transition is None:
+    if machine.concurrent or machine.run_to_completion:
+        for group in groups.values():
+            for instance in group:
+                dispatch(instance, event)
         return
-    to_state = machine.get_state(transition['to_state'])
-
-    before = transition['before']
-    if isinstance(before, string_types):
-        before = getattr(instance, before)
-    if before:
-        before(state, event, instance)
-    machine._exit_state(state, event, instance, to_state)
-    machine._enter_state(to_state, event, instance, state)
-    after = transition['after']
-    if isinstance(after, string_types):
-        after = getattr(instance, after)
-    if after:
-        after(to_state, event, instance)
+    compiled = machine._compiled
+    if compiled is None:
+        compiled = machine.compile()._compiled
+    select, apply = machine._select, machine._apply
+    for code, group in groups.items():
+        try:
+            state, records = compiled[code]
+        except TypeError:
+            raise NoState(f'{group[0]} is not in any state')
+        records = records.get(event.name) or \
+            machine._fallback_records(state, event)
+        shared = records[0] if records and not records[0][0] else None
+        for instance in group:
+            state._on(event, instance)
+            record = shared or select(records, state, event, instance)
+            if record is not None:
+                apply(record, state, event, instance)
+            if machine.regions:
+                machine._dispatch_regions(
+                    compiled, instance, event, bool(records)
+                )
+
+
+def feed(instance, events, stop_states=()):
+    '''Dispatch a stream of events to one instance.
+
+    Same as calling :func:`dispatch` for every event, but the machine
+    context is resolved once for the whole stream. Feeding stops early
+    once the instance enters one of `stop_states`.
+
+    With :attr:`.Machine.concurrent` or :attr:`.Machine.run_to_completion`
+    set, every event goes through :func:`dispatch` instead, see
+    :func:`_feed_dispatching`.
+
+    :param events: events to be dispatched, consumed lazily
+    :type events: |Iterable| of :class:`.Event`
+
+    :param stop_states: names of terminal states
+    :type stop_states: |Iterable|
+
+    :returns: number of events consumed
+    '''
+    machine = instance.machine
+    stop_codes = machine._stop_codes(stop_states)
+    if machine.concurrent or machine.run_to_completion:
+        return _feed_dispatching(instance, events, stop_codes)
+    compiled = machine._compiled
+    if compiled is None:
+        compiled = machine.compile()._compiled
+    select, fallback = machine._select, machine._fallback_records
+    exit_state, enter_state = machine._exit_state, machine._enter_state
+
+    consumed = 0
+    if instance._state_code in stop_codes:
+        return consumed
+    for event in events:
+        consumed += 1
+        try:
+            state, records = compiled[instance._state_code]
+        except TypeError:
+            raise NoState(f'{instance} is not in any state')
+        state._on(event, instance)
+        records = records.get(event.name) or fallback(state, event)
+        record = select(records, state, event, instance)
+        if record is not None:
+            _, to_state, before, after, _ = record
+
+            if before:
+                if before.__class__ is str:
+                    before = getattr(instance, before)
+                before(state, event, instance)
+            exit_state(state, event, instance, to_state)
+            enter_state(to_state, event, instance, state)
+            if after:
+                if after.__class__ is str:
+                    after = getattr(instance, after)
+                after(to_state, event, instance)
+        if machine.regions:
+            machine._dispatch_regions(
+                compiled, instance, event, bool(records)
+            )
+        if instance._state_code in stop_codes:
+            break
+    return consumed
+
+
+def _feed_dispatching(instance, events, stop_codes):
+    '''Dispatch `events` one by one with :func:`dispatch`.
+
+    :func:`feed` for machines with a dispatch mode. An event queued behind
+    one running in another thread is counted as consumed even though the
+    instance only enters a stop state later.
+    '''
+    consumed = 0
+    if instance._state_code in stop_codes:
+        return consumed
+    for event in events:
+        consumed += 1
+        dispatch(instance, event)
+        if instance._state_code in stop_codes:
+            break
+    return consumed
+
+
+def feed_inputs(instance, event_name, inputs, stop_states=()):
+    '''Dispatch an `event_name` event for every item of `inputs`.
+
+    A single event object is reused for the whole stream, only its `input`
+    changes, so callbacks must not keep references to it. Machines with a
+    dispatch mode get a new event per input, as these may be queued. See
+    :func:`feed`.
+
+    :param inputs: event inputs, e.g. a string to parse char by char
+    :type inputs: |Iterable|
+
+    :returns: number of inputs consumed
+    '''
+    machine = instance.machine
+    if machine.concurrent or machine.run_to_completion:
+        events = (machine.EventClass(event_name, value) for value in inputs)
+        return feed(instance, events, stop_states)
+    event = machine.EventClass(event_name)
+
+    def events():
+        for value in inputs:
+            event.input = value
+            yield event
+    return feed(instance, events(), stop_states)